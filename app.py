@@ -10,12 +10,33 @@ import sys
 import os
 import tempfile
 import json
+import math
+import hashlib
+import hmac
+import cProfile
+import functools
+import random
+import mimetypes
+import shutil
+import subprocess
+import zipfile
+import xml.etree.ElementTree as ET
+import re
+import socket
+import sqlite3
+import ssl
+import threading
+import time
 import requests
 from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from pathlib import Path
+from urllib.parse import urlparse, unquote_plus
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Flask, request, abort
-from openai import OpenAI
+from flask import Flask, request, abort, jsonify, send_from_directory
+from openai import OpenAI, APITimeoutError
 from dotenv import load_dotenv
 
 from linebot.v3 import (
@@ -34,23 +55,42 @@ from linebot.v3.messaging import (
     MessagingApi,
     MessagingApiBlob,
     ReplyMessageRequest,
+    PushMessageRequest,
     TextMessage
 )
 from linebot.v3.webhooks import (
     MessageEvent,
     TextMessageContent,
     AudioMessageContent,
-    ImageMessageContent
+    ImageMessageContent,
+    VideoMessageContent,
+    FileMessageContent
 )
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaFileUpload
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2
 from bs4 import BeautifulSoup
 from apify_client import ApifyClient
 
+try:
+    # 選用：擷取 PDF 文字 (pip install pypdf)
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+try:
+    # 精確計算 token 數 (已列於 requirements.txt)；未安裝時以字元數估算
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
 app = Flask(__name__)
+if tiktoken is None:
+    app.logger.warning("tiktoken is not installed; token counts and truncation fall back to a character-based estimate.")
 
 # 取得環境變數
 channel_secret = os.getenv('LINE_CHANNEL_SECRET')
@@ -77,34 +117,924 @@ openai_client = OpenAI(api_key=openai_api_key)
 # 初始化 Apify Client
 apify_client = ApifyClient(apify_api_token) if apify_api_token else None
 
-def get_ai_title_and_summary(text):
+# 工作日誌 (SQLite WAL)：記錄每則訊息的處理階段與中間結果，重啟後可從上次完成的階段續跑
+JOB_DB_PATH = os.getenv('JOB_DB_PATH', 'jobs.db')
+JOB_DATA_DIR = os.getenv('JOB_DATA_DIR', 'job_data')
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', '90'))
+JOB_RECOVERY_INTERVAL = int(os.getenv('JOB_RECOVERY_INTERVAL', '30'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+JOB_RETENTION_DAYS = int(os.getenv('JOB_RETENTION_DAYS', '7'))
+JOB_STAGES = ["accepted", "downloaded", "transcribed", "summarized", "saved", "replied"]
+
+_journal_local = threading.local()
+
+def _worker_id():
+    # gunicorn 會 fork 多個 worker，以 host:pid 區分租約擁有者
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def _journal_conn():
+    """取得目前執行緒（與行程）專屬的 SQLite 連線"""
+    conn = getattr(_journal_local, "conn", None)
+    if conn is None or getattr(_journal_local, "pid", None) != os.getpid():
+        conn = sqlite3.connect(JOB_DB_PATH, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _journal_local.conn = conn
+        _journal_local.pid = os.getpid()
+    return conn
+
+def init_job_journal():
+    conn = _journal_conn()
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            data TEXT NOT NULL DEFAULT '{}',
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            owner TEXT,
+            lease_until REAL NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_stage ON jobs (stage, lease_until)")
+    Path(JOB_DATA_DIR).mkdir(parents=True, exist_ok=True)
+
+def journal_get(job_id):
+    row = _journal_conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    job["data"] = json.loads(job["data"])
+    return job
+
+def journal_accept(job_id, user_id, kind, data=None, stage="accepted", lease_seconds=JOB_LEASE_SECONDS):
+    """登記新工作並取得租約；若工作已存在（例如 LINE 重送）則回傳 None"""
+    now = time.time()
+    cur = _journal_conn().execute(
+        "INSERT OR IGNORE INTO jobs (id, user_id, kind, stage, data, owner, lease_until, created_at, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (job_id, user_id, kind, stage, json.dumps(data or {}, ensure_ascii=False),
+         _worker_id(), now + lease_seconds, now, now)
+    )
+    if cur.rowcount == 0:
+        return None
+    return journal_get(job_id)
+
+def journal_advance(job, stage=None, **results):
+    """推進工作階段並保存中間結果（例如逐字稿、Drive 連結），同時延長租約"""
+    job["data"].update(results)
+    if stage:
+        job["stage"] = stage
+    now = time.time()
+    _journal_conn().execute(
+        "UPDATE jobs SET stage = ?, data = ?, lease_until = ?, updated_at = ? WHERE id = ?",
+        (job["stage"], json.dumps(job["data"], ensure_ascii=False), now + JOB_LEASE_SECONDS, now, job["id"])
+    )
+
+def journal_merge_pending(members, build):
+    """把同一組待合併 (pending) 的工作併成一個。members 為 [(id, attempts)]，只併入仍為 pending
+    且 attempts 未變的成員 (已被復原流程或另一個 leader 收下的不動)，以其中最早的訊息作為 leader；
+    build(成員工作) 回傳 leader 的 (kind, data)。沒有可合併的成員時回傳 None。"""
+    conn = _journal_conn()
+    conn.execute("BEGIN IMMEDIATE")
     try:
-        # 第一步：生成標題
-        title_resp = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "請為這段文字產生一個精簡的標題（10-15字），不要包含標點符號或'標題'二字。"},
-                {"role": "user", "content": text}
-            ]
+        merged = []
+        for job_id, attempts in members:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE id = ? AND stage = 'pending' AND attempts = ?", (job_id, attempts)
+            ).fetchone()
+            if row:
+                merged.append(dict(row, data=json.loads(row["data"])))
+        if not merged:
+            conn.execute("ROLLBACK")
+            return None
+        merged.sort(key=lambda job: job["created_at"])
+        leader = merged[0]
+        kind, data = build(merged)
+        now = time.time()
+        for job in merged:
+            if job is not leader:
+                job["data"]["merged_into"] = leader["id"]
+                conn.execute(
+                    "UPDATE jobs SET stage = 'replied', data = ?, updated_at = ? WHERE id = ?",
+                    (json.dumps(job["data"], ensure_ascii=False), now, job["id"])
+                )
+        leader.update(kind=kind, stage="accepted", owner=_worker_id(), lease_until=now + JOB_LEASE_SECONDS)
+        leader["data"].update(data)
+        conn.execute(
+            "UPDATE jobs SET kind = ?, stage = 'accepted', data = ?, owner = ?, lease_until = ?, updated_at = ? WHERE id = ?",
+            (kind, json.dumps(leader["data"], ensure_ascii=False), leader["owner"], leader["lease_until"], now, leader["id"])
+        )
+        conn.execute("COMMIT")
+        return leader
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def journal_fail(job, error):
+    job["stage"] = "failed"
+    _journal_conn().execute(
+        "UPDATE jobs SET stage = 'failed', error = ?, updated_at = ? WHERE id = ?",
+        (error[:2000], time.time(), job["id"])
+    )
+
+def stage_done(job, stage):
+    return job["stage"] in JOB_STAGES and JOB_STAGES.index(job["stage"]) >= JOB_STAGES.index(stage)
+
+def journal_renew_leases():
+    """替本行程仍在處理中的工作續約，避免被其他 worker 視為中斷而重複執行。
+    待合併 (pending) 的訊息不續約：leader 未在合併視窗內收下時，由復原流程重建整批。"""
+    _journal_conn().execute(
+        "UPDATE jobs SET lease_until = ? WHERE owner = ? AND stage NOT IN ('replied', 'failed', 'pending')",
+        (time.time() + JOB_LEASE_SECONDS, _worker_id())
+    )
+
+def journal_claim_stale(limit=10):
+    """認領租約已過期（原處理行程已中斷）的未完成工作"""
+    now = time.time()
+    conn = _journal_conn()
+    rows = conn.execute(
+        "SELECT id FROM jobs WHERE stage NOT IN ('replied', 'failed') AND lease_until < ? "
+        "ORDER BY created_at LIMIT ?",
+        (now, limit)
+    ).fetchall()
+    claimed = []
+    for row in rows:
+        # 以條件式 UPDATE 原子認領，多個 worker 同時掃描也只有一個會成功
+        cur = conn.execute(
+            "UPDATE jobs SET owner = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ? AND lease_until < ?",
+            (_worker_id(), now + JOB_LEASE_SECONDS, row["id"], now)
+        )
+        if cur.rowcount:
+            claimed.append(journal_get(row["id"]))
+    return claimed
+
+def journal_prune():
+    cutoff = time.time() - JOB_RETENTION_DAYS * 86400
+    _journal_conn().execute(
+        "DELETE FROM jobs WHERE stage IN ('replied', 'failed') AND updated_at < ?", (cutoff,)
+    )
+
+# 共享狀態 (快取、去重、限流、鎖、佇列)：
+#   memory://                 單一 worker 內有效（預設）
+#   sqlite:///state.db        同一台機器上的多個 gunicorn worker 共用
+#   redis://[:密碼@]主機:埠/db  跨機器共用 (任何支援 Redis 協定的伺服器)
+STATE_BACKEND_URL = os.getenv('STATE_BACKEND_URL', 'memory://')
+
+class InMemoryStateBackend:
+    """行程內的狀態儲存；所有值皆為字串，ttl 以秒為單位"""
+
+    def __init__(self):
+        self._data = {}
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key):
+        item = self._data.get(key)
+        if item and item[1] is not None and item[1] <= time.time():
+            del self._data[key]
+            return None
+        return item
+
+    def get(self, key):
+        with self._lock:
+            item = self._live(key)
+            return item[0] if item else None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time.time() + ttl if ttl else None)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key, amount=1, ttl=None):
+        """原子遞增；ttl 只在鍵第一次建立時設定（固定視窗計數器）"""
+        with self._lock:
+            item = self._live(key)
+            if item:
+                value = int(item[0]) + amount
+                expires_at = item[1]
+            else:
+                value = amount
+                expires_at = time.time() + ttl if ttl else None
+            self._data[key] = (str(value), expires_at)
+            return value
+
+    def set_if_absent(self, key, value, ttl=None):
+        """鍵不存在時才寫入並回傳 True，可作為跨 worker 的鎖或去重標記"""
+        with self._lock:
+            if self._live(key):
+                return False
+            self._data[key] = (value, time.time() + ttl if ttl else None)
+            return True
+
+    def push(self, queue, value):
+        with self._lock:
+            self._queues.setdefault(queue, []).append(value)
+
+    def pop(self, queue):
+        """取出佇列最舊的項目，佇列為空時回傳 None"""
+        with self._lock:
+            items = self._queues.get(queue)
+            return items.pop(0) if items else None
+
+    def prune(self):
+        with self._lock:
+            now = time.time()
+            for key in [key for key, (_, expires_at) in self._data.items() if expires_at is not None and expires_at <= now]:
+                del self._data[key]
+
+class SQLiteStateBackend:
+    """以 SQLite 檔案保存狀態，同一台機器上的多個 worker 可共用"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, value TEXT NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_queue_name ON queue (name, id)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _transaction(self):
+        # BEGIN IMMEDIATE 先取得寫入鎖，讓「讀取後寫入」在多個行程間保持原子性
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl=None):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, time.time() + ttl if ttl else None)
         )
-        title = title_resp.choices[0].message.content.strip()
 
-        # 第二步：生成摘要
-        summary_resp = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
+    def delete(self, key):
+        self._conn().execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def incr(self, key, amount=1, ttl=None):
+        conn = self._transaction()
+        try:
+            now = time.time()
+            row = conn.execute(
+                "SELECT value, expires_at FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (key, now)
+            ).fetchone()
+            if row:
+                value, expires_at = int(row[0]) + amount, row[1]
+            else:
+                value, expires_at = amount, now + ttl if ttl else None
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, str(value), expires_at)
+            )
+            conn.execute("COMMIT")
+            return value
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def set_if_absent(self, key, value, ttl=None):
+        conn = self._transaction()
+        try:
+            now = time.time()
+            conn.execute("DELETE FROM kv WHERE key = ? AND expires_at IS NOT NULL AND expires_at <= ?", (key, now))
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, now + ttl if ttl else None)
+            )
+            conn.execute("COMMIT")
+            return cur.rowcount == 1
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def push(self, queue, value):
+        self._conn().execute("INSERT INTO queue (name, value) VALUES (?, ?)", (queue, value))
+
+    def pop(self, queue):
+        conn = self._transaction()
+        try:
+            row = conn.execute("SELECT id, value FROM queue WHERE name = ? ORDER BY id LIMIT 1", (queue,)).fetchone()
+            if row:
+                conn.execute("DELETE FROM queue WHERE id = ?", (row[0],))
+            conn.execute("COMMIT")
+            return row[1] if row else None
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def prune(self):
+        self._conn().execute("DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+
+class RedisStateBackend:
+    """透過 Redis 協定 (RESP) 共享狀態，不需額外套件；每個執行緒各自維持一條連線"""
+
+    def __init__(self, url):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.username = parsed.username
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.use_tls = parsed.scheme == "rediss"
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=5)
+        if self.use_tls:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=self.host)
+        self._local.sock = sock
+        self._local.reader = sock.makefile("rb")
+        self._local.pid = os.getpid()
+        if self.password:
+            if self.username:
+                self._send("AUTH", self.username, self.password)
+            else:
+                self._send("AUTH", self.password)
+        if self.db:
+            self._send("SELECT", self.db)
+
+    def _disconnect(self):
+        sock = getattr(self._local, "sock", None)
+        self._local.sock = None
+        if sock:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def _send(self, *args):
+        parts = [str(a).encode("utf-8") for a in args]
+        payload = b"*%d\r\n" % len(parts) + b"".join(b"$%d\r\n%s\r\n" % (len(p), p) for p in parts)
+        self._local.sock.sendall(payload)
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self._local.reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        prefix, rest = line[:1], line[1:-2]
+        if prefix == b"+":
+            return rest.decode("utf-8")
+        if prefix == b"-":
+            raise RuntimeError(f"Redis error: {rest.decode('utf-8')}")
+        if prefix == b":":
+            return int(rest)
+        if prefix == b"$":
+            length = int(rest)
+            if length == -1:
+                return None
+            return self._local.reader.read(length + 2)[:-2].decode("utf-8")
+        if prefix == b"*":
+            length = int(rest)
+            if length == -1:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise RuntimeError(f"Unexpected Redis reply: {line!r}")
+
+    def _command(self, *args, idempotent=True):
+        # 閒置連線可能已被伺服器關閉，重新連線後重試一次。
+        # 讀取回應逾時代表伺服器可能已經執行了指令，此時非冪等的指令 (INCRBY、RPUSH、LPOP)
+        # 重試會被套用兩次，因此只在連線已關閉或被重設時重試。
+        for attempt in range(2):
+            if getattr(self._local, "sock", None) is None or self._local.pid != os.getpid():
+                self._connect()
+            try:
+                return self._send(*args)
+            except (ConnectionError, OSError) as e:
+                self._disconnect()
+                if attempt or (not idempotent and isinstance(e, TimeoutError)):
+                    raise
+
+    def get(self, key):
+        return self._command("GET", key)
+
+    def set(self, key, value, ttl=None):
+        if ttl:
+            self._command("SET", key, value, "EX", int(ttl))
+        else:
+            self._command("SET", key, value)
+
+    def delete(self, key):
+        self._command("DEL", key)
+
+    def incr(self, key, amount=1, ttl=None):
+        value = self._command("INCRBY", key, amount, idempotent=False)
+        if ttl and value == amount:
+            self._command("EXPIRE", key, int(ttl))
+        return value
+
+    def set_if_absent(self, key, value, ttl=None):
+        # 第一次其實已寫入時，重試會回傳 nil 而誤判為已被他人取得
+        if ttl:
+            return self._command("SET", key, value, "NX", "EX", int(ttl), idempotent=False) == "OK"
+        return self._command("SET", key, value, "NX", idempotent=False) == "OK"
+
+    def push(self, queue, value):
+        self._command("RPUSH", queue, value, idempotent=False)
+
+    def pop(self, queue):
+        return self._command("LPOP", queue, idempotent=False)
+
+    def prune(self):
+        # Redis 自行清除過期的鍵
+        pass
+
+def create_state_backend(url):
+    if url.startswith("redis://") or url.startswith("rediss://"):
+        return RedisStateBackend(url)
+    if url.startswith("sqlite://"):
+        return SQLiteStateBackend(url[len("sqlite:///"):] or "state.db")
+    return InMemoryStateBackend()
+
+state_backend = create_state_backend(STATE_BACKEND_URL)
+
+SCRAPE_CACHE_TTL = int(os.getenv('SCRAPE_CACHE_TTL', '3600'))
+SUMMARY_CACHE_TTL = int(os.getenv('SUMMARY_CACHE_TTL', '86400'))
+USER_RATE_LIMIT_PER_MINUTE = int(os.getenv('USER_RATE_LIMIT_PER_MINUTE', '0'))
+
+def shared_once(key, compute, lock_ttl=300, wait=120):
+    """跨 worker 的 single-flight：同一個 key 只讓一個 worker 計算，其他 worker 等待共享結果。
+    compute 需自行把成功的結果寫入 key。"""
+    cached = state_backend.get(key)
+    if cached is not None:
+        return cached
+    lock_key = f"lock:{key}"
+    if state_backend.set_if_absent(lock_key, _worker_id(), ttl=lock_ttl):
+        try:
+            return compute()
+        finally:
+            state_backend.delete(lock_key)
+    # 其他 worker 正在處理同一個 key
+    give_up_at = time.time() + wait
+    while time.time() < give_up_at:
+        time.sleep(1)
+        cached = state_backend.get(key)
+        if cached is not None:
+            return cached
+        if state_backend.get(lock_key) is None:
+            break
+    return compute()
+
+def is_rate_limited(user_id):
+    if USER_RATE_LIMIT_PER_MINUTE <= 0:
+        return False
+    window = int(time.time() // 60)
+    count = state_backend.incr(f"rate:{user_id}:{window}", ttl=60)
+    return count > USER_RATE_LIMIT_PER_MINUTE
+
+# 連續傳送的圖片或 /a 筆記在視窗內合併處理 (0 表示關閉)；LINE 的 imageSet 一律依組合併
+BURST_WINDOW_SECONDS = float(os.getenv('BURST_WINDOW_SECONDS', '3'))
+BURST_MAX_WAIT_SECONDS = float(os.getenv('BURST_MAX_WAIT_SECONDS', '15'))
+# 待合併訊息的租約在合併視窗結束後再保留這麼久，之後視為 leader 已中斷，由復原流程重建整批
+BURST_PENDING_GRACE_SECONDS = 30
+
+def drain_queue(queue):
+    """取出佇列中所有以 JSON 儲存的項目"""
+    items = []
+    while True:
+        value = state_backend.pop(queue)
+        if value is None:
+            return items
+        items.append(json.loads(value))
+
+def coalesce_burst(group_key, item, window, expected=None):
+    """把項目放進群組佇列。第一個到達的事件成為 leader，等到視窗內沒有新項目
+    (或已收到 expected 個) 後取出整批並回傳；其他事件回傳 None，交由 leader 處理。"""
+    queue = f"burst:{group_key}"
+    ttl = BURST_MAX_WAIT_SECONDS + 60
+    state_backend.push(queue, json.dumps(item, ensure_ascii=False))
+    state_backend.set(f"{queue}:last", str(time.time()), ttl=ttl)
+    state_backend.incr(f"{queue}:count", ttl=ttl)
+    if not state_backend.set_if_absent(f"{queue}:leader", _worker_id(), ttl=ttl):
+        return None
+
+    started_at = time.time()
+    while time.time() - started_at < BURST_MAX_WAIT_SECONDS:
+        if expected and int(state_backend.get(f"{queue}:count") or 0) >= expected:
+            break
+        if time.time() - float(state_backend.get(f"{queue}:last") or 0) >= window:
+            break
+        time.sleep(0.2)
+
+    batch = drain_queue(queue)
+    state_backend.delete(f"{queue}:count")
+    state_backend.delete(f"{queue}:leader")
+    # 解除 leader 之前已推入的項目，其事件看到 leader 仍存在而不會自行處理，這裡一併收下
+    batch += drain_queue(queue)
+    return batch
+
+# 每個事件的時間預算：reply token 過期前必須回覆，預算由 webhook 的 timestamp 起算
+REPLY_BUDGET_SECONDS = float(os.getenv('REPLY_BUDGET_SECONDS', '50'))
+# webhook 請求最多等待工作到預算用完，之後工作交給背景執行緒以 push 送出；
+# gunicorn worker 逾時 (Procfile 以 WEB_TIMEOUT 設定) 會直接終止 worker，預算需比它短
+WEB_TIMEOUT = float(os.getenv('WEB_TIMEOUT', '90'))
+REPLY_BUDGET_SECONDS = min(REPLY_BUDGET_SECONDS, WEB_TIMEOUT - 10)
+# 剩餘時間低於門檻時依序降級：先把 Notion 延到回覆後於背景儲存，再縮短摘要，最後改用 push 送出。
+# 門檻由高到低，因此較後的降級觸發時，較前的降級也必定已生效。
+DEGRADE_DEFER_NOTION_BELOW = float(os.getenv('DEGRADE_DEFER_NOTION_BELOW', '30'))
+DEGRADE_SHORT_SUMMARY_BELOW = float(os.getenv('DEGRADE_SHORT_SUMMARY_BELOW', '20'))
+DEGRADE_PUSH_BELOW = float(os.getenv('DEGRADE_PUSH_BELOW', '3'))
+# 估算模型輸出速度，用來依剩餘時間決定 max_tokens
+OPENAI_OUTPUT_TOKENS_PER_SECOND = float(os.getenv('OPENAI_OUTPUT_TOKENS_PER_SECOND', '40'))
+
+class Deadline:
+    """事件的截止時間；各階段依剩餘時間設定逾時與 max_tokens，並記錄觸發過的降級"""
+
+    def __init__(self, expires_at):
+        self.expires_at = expires_at
+        self.degradations = []
+
+    @classmethod
+    def from_event(cls, event):
+        # event.timestamp 為毫秒；LINE 重送的舊事件剩餘時間可能已經是負的
+        return cls(event.timestamp / 1000 + REPLY_BUDGET_SECONDS)
+
+    @classmethod
+    def unbounded(cls):
+        # 背景續跑或延後的工作沒有 reply token，不受時間預算限制
+        return cls(float("inf"))
+
+    def remaining(self):
+        return self.expires_at - time.time()
+
+    def degrade(self, name):
+        if name not in self.degradations:
+            self.degradations.append(name)
+            app.logger.warning(f"Degradation '{name}' fired with {self.remaining():.1f}s left in budget")
+
+    def below(self, threshold, name):
+        """剩餘時間低於門檻時觸發指定的降級並回傳 True"""
+        if name in self.degradations:
+            return True
+        if self.remaining() < threshold:
+            self.degrade(name)
+            return True
+        return False
+
+    def push_only(self):
+        return self.below(DEGRADE_PUSH_BELOW, "push_delivery")
+
+    def timeout(self, cap, floor=0):
+        """回傳上游呼叫的逾時秒數；剩餘時間連 floor 都不夠時改以 push 送出並不再壓縮逾時
+        (此時 webhook 請求已不再等待，工作在背景執行緒中完成)"""
+        if self.remaining() < floor:
+            self.degrade("push_delivery")
+        if self.push_only():
+            return cap
+        return min(cap, self.remaining())
+
+    def max_tokens(self, cap):
+        if self.push_only() or self.expires_at == float("inf"):
+            return cap
+        # 最多用一半的剩餘時間產生輸出，保留時間給後續階段
+        return min(cap, max(64, int(self.remaining() / 2 * OPENAI_OUTPUT_TOKENS_PER_SECOND)))
+
+UPSTREAM_TIMEOUT_ERRORS = (requests.exceptions.Timeout, APITimeoutError, TimeoutError)
+
+def call_with_budget(deadline, cap, call, floor=0):
+    """以剩餘預算作為逾時呼叫上游；若只是因預算被壓縮而逾時，改走 push 並以完整逾時重試一次"""
+    timeout = deadline.timeout(cap, floor)
+    try:
+        return call(timeout)
+    except UPSTREAM_TIMEOUT_ERRORS:
+        if timeout >= cap:
+            raise
+        deadline.degrade("push_delivery")
+        return call(cap)
+
+SUMMARY_MAX_TOKENS = int(os.getenv('SUMMARY_MAX_TOKENS', '1000'))
+SHORT_SUMMARY_MAX_TOKENS = int(os.getenv('SHORT_SUMMARY_MAX_TOKENS', '250'))
+DIGEST_MAX_TOKENS = int(os.getenv('DIGEST_MAX_TOKENS', '1500'))
+# 爬取或轉錄的原文最多保留的 token 數，送出前再依選用模型的輸入上限裁切
+SOURCE_MAX_TOKENS = int(os.getenv('SOURCE_MAX_TOKENS', '8000'))
+
+_encoders = {}
+
+def _encoder(model):
+    if model not in _encoders:
+        try:
+            _encoders[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encoders[model] = tiktoken.get_encoding("cl100k_base")
+    return _encoders[model]
+
+def _char_tokens(char):
+    # 估算：中日韓文字約一字一個 token，其他文字約四個字元一個 token
+    return 1 if ord(char) >= 0x2E80 else 0.25
+
+def count_tokens(text, model="gpt-3.5-turbo"):
+    if tiktoken:
+        return len(_encoder(model).encode(text, disallowed_special=()))
+    return int(sum(_char_tokens(char) for char in text)) + 1
+
+def truncate_to_tokens(text, limit, model="gpt-3.5-turbo"):
+    """依 token 數截斷文字，取代固定字元數的切片"""
+    if tiktoken:
+        encoder = _encoder(model)
+        tokens = encoder.encode(text, disallowed_special=())
+        return text if len(tokens) <= limit else encoder.decode(tokens[:limit])
+    used = 0
+    for i, char in enumerate(text):
+        used += _char_tokens(char)
+        if used > limit:
+            return text[:i]
+    return text
+
+# GPT-4o 高解析度圖片約 765 個輸入 token (依圖片大小分塊計費)
+VISION_TOKENS_PER_IMAGE = 765
+
+# 路由表：每個用途依偏好順序列出候選模型 (便宜的在前)。
+# max_input_tokens 為可接受的輸入上限；max_tokens、timeout 為輸出與逾時上限；
+# output_ratio 讓輸出上限隨輸入長度調整，短文不必預留完整的摘要長度。
+DEFAULT_MODEL_ROUTES = {
+    "title": [
+        {"model": "gpt-3.5-turbo", "max_input_tokens": 14000, "max_tokens": 60, "timeout": 20},
+        {"model": "gpt-4o-mini", "max_input_tokens": 120000, "max_tokens": 60, "timeout": 20},
+    ],
+    "summary": [
+        {"model": "gpt-3.5-turbo", "max_input_tokens": 14000, "max_tokens": SUMMARY_MAX_TOKENS, "output_ratio": 0.5, "timeout": 60},
+        {"model": "gpt-4o-mini", "max_input_tokens": 120000, "max_tokens": SUMMARY_MAX_TOKENS, "output_ratio": 0.5, "timeout": 60},
+    ],
+    "short_summary": [
+        {"model": "gpt-3.5-turbo", "max_input_tokens": 14000, "max_tokens": SHORT_SUMMARY_MAX_TOKENS, "timeout": 20},
+        {"model": "gpt-4o-mini", "max_input_tokens": 120000, "max_tokens": SHORT_SUMMARY_MAX_TOKENS, "timeout": 20},
+    ],
+    "digest": [
+        {"model": "gpt-3.5-turbo", "max_input_tokens": 14000, "max_tokens": SUMMARY_MAX_TOKENS, "timeout": 60},
+        {"model": "gpt-4o-mini", "max_input_tokens": 120000, "max_tokens": SUMMARY_MAX_TOKENS, "timeout": 60},
+    ],
+    "daily_digest": [
+        {"model": "gpt-3.5-turbo", "max_input_tokens": 14000, "max_tokens": DIGEST_MAX_TOKENS, "timeout": 120},
+        {"model": "gpt-4o-mini", "max_input_tokens": 120000, "max_tokens": DIGEST_MAX_TOKENS, "timeout": 120},
+    ],
+    "vision": [
+        {"model": "gpt-4o", "max_input_tokens": 120000, "max_tokens": 500, "timeout": 60},
+    ],
+    "transcription": [
+        {"model": "whisper-1", "timeout": 120},
+    ],
+}
+
+def load_model_routes():
+    """預設路由表，再以 MODEL_ROUTES_FILE 或 MODEL_ROUTES_JSON 逐個用途覆寫"""
+    routes = dict(DEFAULT_MODEL_ROUTES)
+    overrides = {}
+    routes_file = os.getenv('MODEL_ROUTES_FILE')
+    if routes_file:
+        with open(routes_file, "r", encoding="utf-8") as f:
+            overrides.update(json.load(f))
+    if os.getenv('MODEL_ROUTES_JSON'):
+        overrides.update(json.loads(os.getenv('MODEL_ROUTES_JSON')))
+    for route, candidates in overrides.items():
+        if not candidates or not all(candidate.get("model") for candidate in candidates):
+            raise ValueError(f"Model route '{route}' needs at least one candidate with a model name")
+        routes[route] = candidates
+    return routes
+
+# 近期呼叫視窗內錯誤率超過門檻的模型會被排到後面
+MODEL_STATS_WINDOW = int(os.getenv('MODEL_STATS_WINDOW', '50'))
+MODEL_MIN_SAMPLES = int(os.getenv('MODEL_MIN_SAMPLES', '5'))
+MODEL_MAX_ERROR_RATE = float(os.getenv('MODEL_MAX_ERROR_RATE', '0.3'))
+MODEL_PROBE_RATE = float(os.getenv('MODEL_PROBE_RATE', '0.05'))
+
+class ModelRouter:
+    """依輸入 token 數、剩餘時間與各模型近期的延遲與錯誤率挑選模型，並記錄每條路由的統計"""
+
+    def __init__(self, routes):
+        self.routes = routes
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def _stats(self, route, model):
+        key = (route, model)
+        if key not in self.stats:
+            self.stats[key] = {
+                "calls": 0, "errors": 0, "latency_ewma": None,
+                "recent": deque(maxlen=MODEL_STATS_WINDOW),
+                "input_tokens": 0, "output_tokens": 0
+            }
+        return self.stats[key]
+
+    @staticmethod
+    def _error_rate(stats):
+        recent = stats["recent"]
+        if len(recent) < MODEL_MIN_SAMPLES:
+            return 0.0
+        return recent.count(False) / len(recent)
+
+    def rank(self, route, input_tokens, deadline):
+        """放得下輸入的候選依偏好排序；近期太慢 (超過剩餘時間) 或錯誤率過高的排到最後"""
+        candidates = self.routes[route]
+        fitting = [c for c in candidates if input_tokens <= c.get("max_input_tokens", float("inf"))]
+        if not fitting:
+            # 都放不下時用上限最大的模型，輸入由呼叫端依 max_input_tokens 截斷
+            fitting = [max(candidates, key=lambda c: c.get("max_input_tokens", float("inf")))]
+        remaining = deadline.remaining()
+        healthy, unhealthy = [], []
+        with self.lock:
+            for candidate in fitting:
+                stats = self.stats.get((route, candidate["model"]))
+                too_slow = stats and stats["latency_ewma"] is not None and stats["latency_ewma"] > remaining
+                failing = stats and self._error_rate(stats) > MODEL_MAX_ERROR_RATE
+                # 偶爾仍讓被降級的模型先試，才能得知它是否已恢復
+                if (too_slow or failing) and random.random() >= MODEL_PROBE_RATE:
+                    unhealthy.append(candidate)
+                else:
+                    healthy.append(candidate)
+        return healthy + unhealthy
+
+    @staticmethod
+    def output_cap(candidate, input_tokens):
+        cap = candidate.get("max_tokens", SUMMARY_MAX_TOKENS)
+        if "output_ratio" in candidate:
+            cap = min(cap, max(128, int(input_tokens * candidate["output_ratio"])))
+        return cap
+
+    def record(self, route, model, latency, ok, usage=None):
+        with self.lock:
+            stats = self._stats(route, model)
+            stats["calls"] += 1
+            stats["recent"].append(ok)
+            if not ok:
+                stats["errors"] += 1
+                return
+            ewma = stats["latency_ewma"]
+            stats["latency_ewma"] = latency if ewma is None else 0.8 * ewma + 0.2 * latency
+            if usage is not None:
+                stats["input_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+                stats["output_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+
+    def call(self, route, deadline, request, input_tokens=0, floor=0, extra_timeout=0):
+        """request(candidate, timeout) 送出實際呼叫；失敗時改用下一個候選模型重試一次"""
+        attempts = self.rank(route, input_tokens, deadline)[:2]
+        for i, candidate in enumerate(attempts):
+            started_at = time.time()
+            try:
+                response = call_with_budget(
+                    deadline, candidate.get("timeout", 60) + extra_timeout,
+                    lambda timeout: request(candidate, timeout), floor=floor
+                )
+            except Exception as e:
+                self.record(route, candidate["model"], time.time() - started_at, ok=False)
+                if i == len(attempts) - 1:
+                    raise
+                app.logger.warning(f"Model {candidate['model']} failed for route '{route}' ({e}); falling back to {attempts[i + 1]['model']}")
+                continue
+            self.record(route, candidate["model"], time.time() - started_at, ok=True, usage=getattr(response, "usage", None))
+            return response
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                route: [
+                    {
+                        "model": candidate["model"],
+                        "calls": stats["calls"],
+                        "errors": stats["errors"],
+                        "recent_error_rate": round(self._error_rate(stats), 3),
+                        "latency_ewma": round(stats["latency_ewma"], 3) if stats["latency_ewma"] is not None else None,
+                        "input_tokens": stats["input_tokens"],
+                        "output_tokens": stats["output_tokens"],
+                    }
+                    for candidate in candidates
+                    for stats in [self._stats(route, candidate["model"])]
+                ]
+                for route, candidates in self.routes.items()
+            }
+
+model_router = ModelRouter(load_model_routes())
+
+def chat_completion(route, system_prompt, text, deadline):
+    """以路由挑選的模型產生回應；輸入依該模型的上限截斷，輸出上限同時受剩餘時間限制"""
+    input_tokens = count_tokens(system_prompt) + count_tokens(text)
+
+    def request(candidate, timeout):
+        limit = candidate.get("max_input_tokens")
+        content = truncate_to_tokens(text, limit - count_tokens(system_prompt), candidate["model"]) if limit else text
+        return openai_client.chat.completions.create(
+            model=candidate["model"],
             messages=[
-                {"role": "system", "content": "請為這段文字產生條列式的重點摘要。"},
-                {"role": "user", "content": text}
-            ]
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": content}
+            ],
+            max_tokens=deadline.max_tokens(model_router.output_cap(candidate, input_tokens)),
+            timeout=timeout
         )
-        summary = summary_resp.choices[0].message.content.strip()
-        
+
+    response = model_router.call(route, deadline, request, input_tokens)
+    return response.choices[0].message.content.strip()
+
+def get_ai_short_title_and_summary(text, deadline):
+    """時間不足時的降級版本：一次呼叫同時產生標題與精簡摘要"""
+    content = chat_completion(
+        "short_summary",
+        "請為這段文字產生精簡標題（10-15字）與最多三點的重點摘要。格式：\n標題：[標題]\n摘要：[摘要]",
+        text,
+        deadline
+    )
+    if "標題：" in content and "摘要：" in content:
+        parts = content.split("摘要：", 1)
+        return parts[0].replace("標題：", "").strip(), parts[1].strip()
+    return text[:20], content
+
+def get_ai_title_and_summary(text, deadline=None):
+    deadline = deadline or Deadline.unbounded()
+
+    # 相同內容（例如多人分享同一篇新聞）直接使用共享快取的結果
+    cache_key = f"summary:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+    cached = state_backend.get(cache_key)
+    if cached is not None:
+        title, summary = json.loads(cached)
+        return title, summary
+
+    try:
+        if deadline.below(DEGRADE_SHORT_SUMMARY_BELOW, "short_summary"):
+            # 縮短的摘要不寫入快取
+            return get_ai_short_title_and_summary(text, deadline)
+
+        # 第一步：生成標題
+        title = chat_completion(
+            "title",
+            "請為這段文字產生一個精簡的標題（10-15字），不要包含標點符號或'標題'二字。",
+            text,
+            deadline
+        )
+
+        # 第二步：生成摘要
+        summary = chat_completion("summary", "請為這段文字產生條列式的重點摘要。", text, deadline)
+
+        state_backend.set(cache_key, json.dumps([title, summary], ensure_ascii=False), ttl=SUMMARY_CACHE_TTL)
         return title, summary
     except Exception as e:
         app.logger.error(f"Error in AI processing: {e}")
         return text[:20], "無法產生摘要"
 
-def save_to_notion_enhanced(text, ai_title, ai_summary, user_id, type_name="語音筆記", url=None):
+def get_ai_digest(links, note="", deadline=None):
+    """將多個連結的摘要彙整成一份綜合摘要"""
+    deadline = deadline or Deadline.unbounded()
+    sections = "\n\n".join(
+        f"{i}. {link['ai_title']}\n{link['ai_summary']}" for i, link in enumerate(links, 1)
+    )
+    if note:
+        sections = f"使用者附註：{note}\n\n{sections}"
+    try:
+        return chat_completion(
+            "digest",
+            "以下是多篇網頁的摘要，請整合成一份條列式的綜合重點，指出共通主題與差異。",
+            sections,
+            deadline
+        )
+    except Exception as e:
+        app.logger.error(f"Error in AI digest processing: {e}")
+        return "無法產生綜合摘要"
+
+# Notion 每個文字物件最多 2000 字；附加區塊時每次最多 100 個，這裡取較小的批次讓請求遠低於 500KB 上限
+NOTION_TEXT_LIMIT = 2000
+NOTION_BLOCK_BATCH = 50
+
+def append_notion_text(page_id, text, headers, deadline):
+    """把完整文字以多個段落區塊附加到頁面內容，全部成功才回傳 True"""
+    blocks = [
+        {"object": "block", "type": "paragraph", "paragraph": {"rich_text": [{"type": "text", "text": {"content": text[i:i + NOTION_TEXT_LIMIT]}}]}}
+        for i in range(0, len(text), NOTION_TEXT_LIMIT)
+    ]
+    for i in range(0, len(blocks), NOTION_BLOCK_BATCH):
+        payload = json.dumps({"children": blocks[i:i + NOTION_BLOCK_BATCH]}, ensure_ascii=False).encode("utf-8")
+        response = call_with_budget(deadline, 15, lambda timeout: requests.patch(
+            f"https://api.notion.com/v1/blocks/{page_id}/children", headers=headers, data=payload, timeout=timeout
+        ))
+        if response.status_code != 200:
+            app.logger.error(f"Failed to append text to Notion page {page_id}. Status: {response.status_code}, Response: {response.text}")
+            return False
+    return True
+
+def save_to_notion_enhanced(text, ai_title, ai_summary, user_id, type_name="語音筆記", url=None, deadline=None, full_text=False):
+    """full_text 為 True 時，除了「內容」欄位的前 2000 字，另將完整文字寫入頁面內容"""
+    deadline = deadline or Deadline.unbounded()
     if not notion_token or not notion_database_id or "your_" in notion_token:
         app.logger.error("Notion configurations are missing or invalid.")
         return False, None
@@ -185,8 +1115,12 @@ def save_to_notion_enhanced(text, ai_title, ai_summary, user_id, type_name="語
 
     try:
         app.logger.info(f"Attempting to save enhanced note to Notion DB: {notion_database_id}")
-        response = requests.post("https://api.notion.com/v1/pages", headers=headers, data=json.dumps(data))
+        response = call_with_budget(deadline, 15, lambda timeout: requests.post(
+            "https://api.notion.com/v1/pages", headers=headers, data=json.dumps(data), timeout=timeout
+        ))
         if response.status_code == 200:
+            if full_text and len(text) > NOTION_TEXT_LIMIT and not append_notion_text(response.json()["id"], text, headers, deadline):
+                return False, current_time_display
             app.logger.info("Successfully saved to Notion.")
             return True, current_time_display
         else:
@@ -196,6 +1130,151 @@ def save_to_notion_enhanced(text, ai_title, ai_summary, user_id, type_name="語
         app.logger.error(f"Error saving to Notion: {e}")
         return False, None
 
+# 效能分析 (預設關閉)：取樣式 profiler 由管理路由開啟 N 秒，另可對部分 webhook 事件做 cProfile
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', '50'))
+# 對多少比例的事件做 cProfile，例如 0.01 表示 1%
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', '120'))
+
+_sampler_lock = threading.Lock()
+
+def prune_profile_dir():
+    """只保留最新的 PROFILE_MAX_FILES 份結果"""
+    files = sorted(Path(PROFILE_DIR).glob("*"), key=lambda p: p.stat().st_mtime, reverse=True)
+    for path in files[PROFILE_MAX_FILES:]:
+        path.unlink(missing_ok=True)
+
+def profile_file_path(*tags, suffix):
+    Path(PROFILE_DIR).mkdir(parents=True, exist_ok=True)
+    name = "_".join([datetime.now().strftime("%Y%m%d_%H%M%S")] + [re.sub(r"[^A-Za-z0-9-]", "", str(t)) for t in tags])
+    return os.path.join(PROFILE_DIR, f"{name}_{os.getpid()}{suffix}")
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+def run_sampling_profiler(seconds, interval):
+    """定期取樣本行程所有執行緒的呼叫堆疊，輸出 flame graph 工具 (flamegraph.pl、speedscope) 可讀的 folded stacks"""
+    counts = {}
+    own_id = threading.get_ident()
+    thread_names = {}
+    stop_at = time.time() + seconds
+    try:
+        while time.time() < stop_at:
+            thread_names.update({t.ident: t.name for t in threading.enumerate()})
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame))
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                key = ";".join(reversed(stack))
+                counts[key] = counts.get(key, 0) + 1
+            time.sleep(interval)
+
+        path = profile_file_path("sampling", f"{seconds}s", suffix=".folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(counts.items()):
+                # flamegraph.pl 以最後一個空白分隔堆疊與次數，堆疊中的空白不影響解析
+                f.write(f"{stack} {count}\n")
+        prune_profile_dir()
+        app.logger.info(f"Sampling profile written to {path}")
+    finally:
+        _sampler_lock.release()
+
+_jobs_in_flight = 0
+_jobs_in_flight_lock = threading.Lock()
+
+def tracked_job(func):
+    """計算本行程進行中的工作數 (webhook、合併批次、復原與回覆後的背景工作)"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        global _jobs_in_flight
+        with _jobs_in_flight_lock:
+            _jobs_in_flight += 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with _jobs_in_flight_lock:
+                _jobs_in_flight -= 1
+    return wrapper
+
+def run_profiled(name, event, work):
+    """依 PROFILE_SAMPLE_RATE 對部分事件的處理做 cProfile，結果以名稱與訊息類型命名。
+    Python 3.12 起 cProfile 以 sys.monitoring 實作，會記錄所有執行緒的呼叫；
+    有其他工作正在進行時不取樣，但取樣期間才開始的背景工作仍可能混入結果"""
+    if PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE:
+        return work()
+    if _jobs_in_flight:
+        return work()
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # 同一時間只能有一個 profiler 啟用 (Python 3.12+)
+        return work()
+    try:
+        return work()
+    finally:
+        profiler.disable()
+        path = profile_file_path(name, event.message.type, event.message.id, suffix=".prof")
+        profiler.dump_stats(path)
+        prune_profile_dir()
+
+def profiled(func):
+    """webhook handler 的 cProfile 取樣；在背景執行緒完成的工作另以 run_profiled 取樣"""
+    @functools.wraps(func)
+    def wrapper(event):
+        return run_profiled(func.__name__, event, lambda: func(event))
+    return wrapper
+
+def require_admin():
+    # 未設定 ADMIN_TOKEN 時管理路由視同不存在
+    if not ADMIN_TOKEN:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get("Authorization", "").encode("utf-8"), f"Bearer {ADMIN_TOKEN}".encode("utf-8")):
+        abort(403)
+
+@app.route("/admin/profile", methods=['POST'])
+def start_sampling_profile():
+    require_admin()
+    try:
+        seconds = int(request.args.get("seconds", 30))
+        interval_ms = float(request.args.get("interval_ms", 10))
+    except ValueError:
+        return jsonify({"error": "seconds and interval_ms must be numbers"}), 400
+    if seconds <= 0 or not math.isfinite(interval_ms):
+        return jsonify({"error": "seconds must be positive and interval_ms finite"}), 400
+    seconds = min(seconds, PROFILE_MAX_SECONDS)
+    interval = max(interval_ms, 1) / 1000
+    if not _sampler_lock.acquire(blocking=False):
+        return jsonify({"error": "sampling profiler is already running"}), 409
+    threading.Thread(target=run_sampling_profiler, args=(seconds, interval), daemon=True).start()
+    return jsonify({"status": "started", "seconds": seconds, "pid": os.getpid()}), 202
+
+@app.route("/admin/profiles", methods=['GET'])
+def list_profiles():
+    require_admin()
+    if not os.path.isdir(PROFILE_DIR):
+        return jsonify([])
+    files = sorted(Path(PROFILE_DIR).glob("*"), key=lambda p: p.stat().st_mtime, reverse=True)
+    return jsonify([{"name": p.name, "size": p.stat().st_size} for p in files])
+
+@app.route("/admin/profiles/<path:name>", methods=['GET'])
+def download_profile(name):
+    require_admin()
+    return send_from_directory(os.path.abspath(PROFILE_DIR), name, as_attachment=True)
+
+@app.route("/admin/models", methods=['GET'])
+def model_route_stats():
+    require_admin()
+    # 統計為各 worker 各自累計，回傳 pid 以便區分
+    return jsonify({"pid": os.getpid(), "tokenizer": "tiktoken" if tiktoken else "estimate", "routes": model_router.snapshot()})
+
 @app.route("/", methods=['GET'])
 def index():
     return "Hello, LINE Bot is running!"
@@ -218,121 +1297,326 @@ def callback():
 
     return 'OK'
 
-def fetch_url_content(url):
+URL_PATTERN = re.compile(r"https?://[^\s<>\"'，。、！？）」』】]+")
+# 常見的追蹤參數，去除後同一篇文章的不同分享連結會被視為同一個網址
+TRACKING_PARAMS = {"fbclid", "gclid", "dclid", "msclkid", "yclid", "igshid", "mibextid", "mc_cid", "mc_eid", "ref_src", "_ga"}
+MAX_URLS_PER_MESSAGE = int(os.getenv('MAX_URLS_PER_MESSAGE', '5'))
+URL_FETCH_CONCURRENCY = int(os.getenv('URL_FETCH_CONCURRENCY', '4'))
+
+def is_tracking_param(part):
+    key = unquote_plus(part.split("=", 1)[0]).lower()
+    return key.startswith("utm_") or key in TRACKING_PARAMS
+
+URL_BRACKETS = {")": "(", "]": "[", "}": "{"}
+
+def strip_trailing_punctuation(url):
+    """去除句尾標點；括號只在網址內沒有對應的左括號時去除 (例如維基百科的 Python_(programming_language))"""
+    while url and url[-1] in ".,;:!?)]}>":
+        opener = URL_BRACKETS.get(url[-1])
+        if opener and url.count(opener) >= url.count(url[-1]):
+            break
+        url = url[:-1]
+    return url
+
+def normalize_url(url):
+    """去除結尾標點與追蹤參數；其餘部分 (其他參數的寫法、編碼與錨點) 一律保持原樣"""
+    url = strip_trailing_punctuation(url)
+    if "?" not in url:
+        return url
+    base, rest = url.split("?", 1)
+    query, hash_mark, fragment = rest.partition("#")
+    kept = [part for part in query.split("&") if not is_tracking_param(part)]
+    query = "&".join(kept)
+    return base + ("?" + query if query else "") + hash_mark + fragment
+
+def extract_urls(text):
+    """找出訊息中所有網址，正規化並去除重複（保留原順序）；回傳 (最多 MAX_URLS_PER_MESSAGE 個網址, 略過的數量)"""
+    urls = []
+    for match in URL_PATTERN.findall(text):
+        url = normalize_url(match)
+        if url not in urls:
+            urls.append(url)
+    return urls[:MAX_URLS_PER_MESSAGE], max(0, len(urls) - MAX_URLS_PER_MESSAGE)
+
+def map_concurrently(func, items, max_workers=URL_FETCH_CONCURRENCY):
+    """以有限的執行緒數同時處理多個項目，回傳順序與輸入相同"""
+    if len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as pool:
+        return list(pool.map(func, items))
+
+# 一般網頁的 HTTP 快取：保存擷取後的純文字與 ETag/Last-Modified，過期後以條件式請求重新驗證
+HTTP_CACHE_DIR = os.getenv('HTTP_CACHE_DIR', 'http_cache')
+HTTP_CACHE_MAX_BYTES = int(os.getenv('HTTP_CACHE_MAX_BYTES', str(50 * 1024 * 1024)))
+# 網站未提供快取標頭時的預設保存秒數 (0 表示每次都重新驗證)
+HTTP_CACHE_DEFAULT_TTL = int(os.getenv('HTTP_CACHE_DEFAULT_TTL', '0'))
+
+def parse_domain_ttls(value):
+    """解析 "udn.com=600,ltn.com.tw=300" 格式的網域 TTL 設定"""
+    ttls = {}
+    for item in value.split(","):
+        if "=" in item:
+            domain, ttl = item.split("=", 1)
+            ttls[domain.strip().lower()] = int(ttl)
+    return ttls
+
+HTTP_CACHE_DOMAIN_TTLS = parse_domain_ttls(os.getenv('HTTP_CACHE_DOMAIN_TTLS', ''))
+
+def domain_cache_ttl(url):
+    host = urlparse(url).hostname or ""
+    for domain, ttl in HTTP_CACHE_DOMAIN_TTLS.items():
+        if host == domain or host.endswith("." + domain):
+            return ttl
+    return HTTP_CACHE_DEFAULT_TTL
+
+def parse_cache_control(value):
+    directives = {}
+    for part in value.split(","):
+        name, _, arg = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = arg.strip('"')
+    return directives
+
+def cache_freshness(url, response):
+    """依回應標頭決定是否可快取，以及可直接使用而不需重新驗證的秒數"""
+    cache_control = parse_cache_control(response.headers.get("Cache-Control", ""))
+    # 多位使用者共用此快取，private 內容也不保存
+    if "no-store" in cache_control or "private" in cache_control:
+        return False, 0
+    if "no-cache" in cache_control:
+        return True, 0
+    for directive in ("s-maxage", "max-age"):
+        if cache_control.get(directive, "").isdigit():
+            return True, int(cache_control[directive])
+    if response.headers.get("Expires"):
+        try:
+            expires = parsedate_to_datetime(response.headers["Expires"])
+            date = parsedate_to_datetime(response.headers["Date"]) if response.headers.get("Date") else datetime.now(timezone.utc)
+            return True, max(0, int((expires - date).total_seconds()))
+        except (TypeError, ValueError):
+            return True, 0
+    return True, domain_cache_ttl(url)
+
+def http_cache_path(url):
+    return os.path.join(HTTP_CACHE_DIR, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+def http_cache_load(url):
+    path = http_cache_path(url)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+        # 更新修改時間，淘汰時視為最近使用
+        os.utime(path)
+        return entry
+    except (OSError, ValueError):
+        return None
+
+def http_cache_store(url, entry):
+    Path(HTTP_CACHE_DIR).mkdir(parents=True, exist_ok=True)
+    path = http_cache_path(url)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(entry, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    http_cache_evict()
+
+def http_cache_evict():
+    """總大小超過上限時，從最久未使用的項目開始刪除"""
+    files = []
+    total = 0
+    for item in os.scandir(HTTP_CACHE_DIR):
+        if item.name.endswith(".json"):
+            stat = item.stat()
+            files.append((stat.st_mtime, stat.st_size, item.path))
+            total += stat.st_size
+    if total <= HTTP_CACHE_MAX_BYTES:
+        return
+    for _, size, path in sorted(files):
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        if total <= HTTP_CACHE_MAX_BYTES * 0.9:
+            break
+
+def extract_page_text(html):
+    # 使用 BeautifulSoup 解析 HTML
+    soup = BeautifulSoup(html, 'html.parser')
+    
+    # 移除 script, style 等不相關標籤
+    for script in soup(["script", "style", "nav", "footer", "iframe"]):
+        script.extract()
+        
+    # 取得純文字
+    text = soup.get_text()
+    
+    # 清理多餘空白
+    lines = (line.strip() for line in text.splitlines())
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+    return '\n'.join(chunk for chunk in chunks if chunk)
+
+def scrape_facebook(url, deadline):
+    """使用 Apify 爬取 Facebook 貼文文字，成功的結果寫入共享快取"""
+    app.logger.info(f"Starting Apify task for Facebook URL: {url}")
+    
+    try:
+        # 使用 apify/facebook-posts-scraper
+        run_input = {
+            "startUrls": [{"url": url}],
+            "resultsLimit": 1,
+        }
+        # 改用 Actor 名稱呼叫
+        app.logger.info(f"Calling Apify Actor with input: {run_input}")
+        run = apify_client.actor("apify/facebook-posts-scraper").call(
+            run_input=run_input,
+            timeout_secs=int(deadline.timeout(APIFY_TIMEOUT_SECONDS, floor=APIFY_MIN_SECONDS))
+        )
+        
+        if not run:
+            app.logger.error("Apify run object is None.")
+            return "Apify 執行失敗（無回傳值）。"
+
+        dataset_id = run.get('defaultDatasetId')
+        app.logger.info(f"Apify run finished. Dataset ID: {dataset_id}")
+        
+        # 取得結果
+        dataset_items = apify_client.dataset(dataset_id).list_items().items
+        app.logger.info(f"Dataset items count: {len(dataset_items)}")
+
+        if dataset_items:
+            post = dataset_items[0]
+            # 印出第一筆資料的結構以供除錯
+            app.logger.info(f"First item keys: {list(post.keys())}")
+            
+            # 嘗試多個可能的文字欄位 (增加 Reels 支援)
+            text = post.get("text") or post.get("postText") or post.get("caption") or post.get("description") or ""
+            
+            if not text:
+                app.logger.warning(f"Text field is empty. Full item for debug: {json.dumps(post, ensure_ascii=False)[:1000]}")
+                return "這是一則 Facebook 貼文或影片，但爬蟲無法提取到文字內容（可能是純影片或隱私設定限制）。"
+            
+            text = truncate_to_tokens(text, SOURCE_MAX_TOKENS)
+            state_backend.set(f"scrape:{url}", text, ttl=SCRAPE_CACHE_TTL)
+            return text
+        else:
+            app.logger.warning("Apify run completed but returned no items.")
+            return "Apify 未能抓取到內容，可能是權限或貼文不存在。"
+    except Exception as e:
+        error_msg = str(e)
+        if "quota" in error_msg.lower() or "limit" in error_msg.lower() or "credit" in error_msg.lower():
+            app.logger.error(f"Apify quota exceeded: {error_msg}")
+            return "抱歉，Facebook 爬蟲額度已用完，請聯絡管理員更新 API Token。"
+        app.logger.error(f"Apify execution failed: {e}", exc_info=True)
+        return f"Facebook 爬蟲執行失敗: {error_msg}"
+
+def scrape_threads(url, deadline):
+    """使用 Apify 爬取 Threads 貼文文字，成功的結果寫入共享快取"""
+    app.logger.info(f"Starting Apify task for Threads URL: {url}")
+    
+    try:
+        # 使用 apify/threads-scraper
+        run_input = {
+            "startUrls": [url],
+            "maxPostCount": 1,
+        }
+        # 改用 Actor 名稱呼叫
+        run = apify_client.actor("apify/threads-scraper").call(
+            run_input=run_input,
+            timeout_secs=int(deadline.timeout(APIFY_TIMEOUT_SECONDS, floor=APIFY_MIN_SECONDS))
+        )
+        
+        dataset_items = apify_client.dataset(run["defaultDatasetId"]).list_items().items
+        if dataset_items:
+            thread = dataset_items[0]
+            text = thread.get("thread_items", [{}])[0].get("post", {}).get("caption", {}).get("text", "")
+            if not text:
+                 text = thread.get("text") or "" # 嘗試其他可能的欄位
+            text = truncate_to_tokens(text, SOURCE_MAX_TOKENS)
+            if text:
+                state_backend.set(f"scrape:{url}", text, ttl=SCRAPE_CACHE_TTL)
+            return text
+        else:
+             app.logger.warning("Apify run completed but returned no items.")
+             return "Apify 未能抓取到內容。"
+    except Exception as e:
+        app.logger.error(f"Apify execution failed: {e}")
+        return f"Threads 爬蟲執行失敗: {str(e)}"
+
+APIFY_TIMEOUT_SECONDS = int(os.getenv('APIFY_TIMEOUT_SECONDS', '300'))
+# Apify 執行通常至少需要這麼久，剩餘預算更少時直接改走 push
+APIFY_MIN_SECONDS = int(os.getenv('APIFY_MIN_SECONDS', '30'))
+
+def fetch_url_content(url, deadline=None):
     """爬取網頁內容並回傳純文字"""
+    deadline = deadline or Deadline.unbounded()
     try:
         # 判斷是否為 Facebook
         if "facebook.com" in url or "fb.watch" in url:
             if not apify_client:
                 app.logger.error("Apify client is not initialized. APIFY_API_TOKEN missing?")
                 return "錯誤：未設定 Apify API Token，無法爬取 Facebook。"
-            app.logger.info(f"Starting Apify task for Facebook URL: {url}")
-            
-            try:
-                # 使用 apify/facebook-posts-scraper
-                run_input = {
-                    "startUrls": [{"url": url}],
-                    "resultsLimit": 1,
-                }
-                # 改用 Actor 名稱呼叫
-                app.logger.info(f"Calling Apify Actor with input: {run_input}")
-                run = apify_client.actor("apify/facebook-posts-scraper").call(run_input=run_input)
-                
-                if not run:
-                    app.logger.error("Apify run object is None.")
-                    return "Apify 執行失敗（無回傳值）。"
-
-                dataset_id = run.get('defaultDatasetId')
-                app.logger.info(f"Apify run finished. Dataset ID: {dataset_id}")
-                
-                # 取得結果
-                dataset_items = apify_client.dataset(dataset_id).list_items().items
-                app.logger.info(f"Dataset items count: {len(dataset_items)}")
-
-                if dataset_items:
-                    post = dataset_items[0]
-                    # 印出第一筆資料的結構以供除錯
-                    app.logger.info(f"First item keys: {list(post.keys())}")
-                    
-                    # 嘗試多個可能的文字欄位 (增加 Reels 支援)
-                    text = post.get("text") or post.get("postText") or post.get("caption") or post.get("description") or ""
-                    
-                    if not text:
-                        app.logger.warning(f"Text field is empty. Full item for debug: {json.dumps(post, ensure_ascii=False)[:1000]}")
-                        return "這是一則 Facebook 貼文或影片，但爬蟲無法提取到文字內容（可能是純影片或隱私設定限制）。"
-                    
-                    return text[:8000]
-                else:
-                    app.logger.warning("Apify run completed but returned no items.")
-                    return "Apify 未能抓取到內容，可能是權限或貼文不存在。"
-            except Exception as e:
-                error_msg = str(e)
-                if "quota" in error_msg.lower() or "limit" in error_msg.lower() or "credit" in error_msg.lower():
-                    app.logger.error(f"Apify quota exceeded: {error_msg}")
-                    return "抱歉，Facebook 爬蟲額度已用完，請聯絡管理員更新 API Token。"
-                app.logger.error(f"Apify execution failed: {e}", exc_info=True)
-                return f"Facebook 爬蟲執行失敗: {error_msg}"
+            # Apify 爬蟲耗時又計費，同一網址在所有 worker 間只爬一次
+            return shared_once(f"scrape:{url}", lambda: scrape_facebook(url, deadline), wait=deadline.timeout(120))
 
         # 判斷是否為 Threads
         elif "threads.net" in url:
             if not apify_client:
                 app.logger.error("Apify client is not initialized. APIFY_API_TOKEN missing?")
                 return "錯誤：未設定 Apify API Token，無法爬取 Threads。"
-            app.logger.info(f"Starting Apify task for Threads URL: {url}")
-            
-            try:
-                # 使用 apify/threads-scraper
-                run_input = {
-                    "startUrls": [url],
-                    "maxPostCount": 1,
-                }
-                # 改用 Actor 名稱呼叫
-                run = apify_client.actor("apify/threads-scraper").call(run_input=run_input)
-                
-                dataset_items = apify_client.dataset(run["defaultDatasetId"]).list_items().items
-                if dataset_items:
-                    thread = dataset_items[0]
-                    text = thread.get("thread_items", [{}])[0].get("post", {}).get("caption", {}).get("text", "")
-                    if not text:
-                         text = thread.get("text") or "" # 嘗試其他可能的欄位
-                    return text[:8000]
-                else:
-                     app.logger.warning("Apify run completed but returned no items.")
-                     return "Apify 未能抓取到內容。"
-            except Exception as e:
-                app.logger.error(f"Apify execution failed: {e}")
-                return f"Threads 爬蟲執行失敗: {str(e)}"
+            return shared_once(f"scrape:{url}", lambda: scrape_threads(url, deadline), wait=deadline.timeout(120))
 
         # 一般網頁爬取
         app.logger.info(f"Starting general web scraping for URL: {url}")
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         }
+        cached = http_cache_load(url)
+        if cached and cached["expires_at"] > time.time():
+            app.logger.info(f"HTTP cache hit for URL: {url}")
+            return cached["text"]
+        if cached:
+            # 以快取的驗證碼發出條件式請求，未變更時伺服器回 304 不傳內容
+            if cached.get("etag"):
+                headers['If-None-Match'] = cached["etag"]
+            if cached.get("last_modified"):
+                headers['If-Modified-Since'] = cached["last_modified"]
         try:
-            response = requests.get(url, headers=headers, timeout=10)
+            response = call_with_budget(deadline, 10, lambda timeout: requests.get(url, headers=headers, timeout=timeout))
             app.logger.info(f"Web request finished. Status Code: {response.status_code}")
+
+            if response.status_code == 304 and cached:
+                # 內容未變更：沿用已解析的文字，略過下載與 BeautifulSoup 解析
+                cacheable, ttl = cache_freshness(url, response)
+                if cacheable:
+                    cached["expires_at"] = time.time() + ttl
+                    cached["etag"] = response.headers.get("ETag", cached.get("etag"))
+                    cached["last_modified"] = response.headers.get("Last-Modified", cached.get("last_modified"))
+                    http_cache_store(url, cached)
+                return cached["text"]
+
             response.raise_for_status()
             
-            # 使用 BeautifulSoup 解析 HTML
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # 移除 script, style 等不相關標籤
-            for script in soup(["script", "style", "nav", "footer", "iframe"]):
-                script.extract()
-                
-            # 取得純文字
-            text = soup.get_text()
-            
-            # 清理多餘空白
-            lines = (line.strip() for line in text.splitlines())
-            chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-            text = '\n'.join(chunk for chunk in chunks if chunk)
+            text = extract_page_text(response.text)
             
             if not text:
                 app.logger.warning("Web scraping returned empty text.")
             
-            # 限制回傳長度，避免 Token 爆量 (取前 8000 字)
-            return text[:8000]
+            # 限制回傳長度，避免 Token 爆量
+            text = truncate_to_tokens(text, SOURCE_MAX_TOKENS)
+
+            cacheable, ttl = cache_freshness(url, response)
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            if text and cacheable and (ttl > 0 or etag or last_modified):
+                http_cache_store(url, {
+                    "url": url,
+                    "etag": etag,
+                    "last_modified": last_modified,
+                    "expires_at": time.time() + ttl,
+                    "text": text,
+                })
+            return text
         except requests.exceptions.RequestException as re:
             app.logger.error(f"Web request failed: {re}")
             return f"網頁請求失敗 (Status: {getattr(re.response, 'status_code', 'Unknown')}): {str(re)}"
@@ -342,557 +1626,1363 @@ def fetch_url_content(url):
         return None
 
 @handler.add(MessageEvent, message=TextMessageContent)
-
+@profiled
 def handle_message(event):
-
     user_id = event.source.user_id
-
     if allowed_user_id and user_id != allowed_user_id:
-
         # 非白名單使用者，不回應或回應無權限
-
         return
 
-
-
     text = event.message.text.strip()
 
+    if text.startswith("/digest"):
+        # 切換每日摘要模式：/digest on | only | off
+        deliver_message(user_id, digest_command_reply(user_id, text[len("/digest"):].strip().lower()), event.reply_token)
 
+    elif text.startswith("/a"):
+        # 處理文字摘要請求
+        content_to_summarize = text[2:].strip()
+        if not content_to_summarize:
+            deliver_message(user_id, "請在 /a 後面加上要摘要的文字。", event.reply_token)
+            return
+        if BURST_WINDOW_SECONDS <= 0:
+            start_job(event, "text", {"text": content_to_summarize})
+        else:
+            # 連續的 /a 筆記合併成一次摘要與一筆 Notion 記錄
+            accept_burst_item(event, "text", f"note:{user_id}", {"text": content_to_summarize}, BURST_WINDOW_SECONDS)
+
+    elif URL_PATTERN.search(text):
+        # 處理網址摘要：訊息中可能有多個連結或附帶說明文字
+        urls, skipped = extract_urls(text)
+        if len(urls) == 1:
+            start_job(event, "url", {"url": urls[0], "skipped_urls": skipped})
+        else:
+            note = URL_PATTERN.sub("", text).strip()
+            start_job(event, "urls", {"urls": urls, "note": note, "skipped_urls": skipped})
 
-    with ApiClient(configuration) as api_client:
-
-        line_bot_api = MessagingApi(api_client)
-
-
-
-        if text.startswith("/a"):
-
-            # 處理文字摘要請求
-
-            content_to_summarize = text[2:].strip()
-
-            if not content_to_summarize:
-
-                line_bot_api.reply_message(
-
-                    ReplyMessageRequest(
-
-                        reply_token=event.reply_token,
+    else:
+        # 回覆一樣的訊息 (Echo)
+        deliver_message(user_id, event.message.text, event.reply_token)
 
-                        messages=[TextMessage(text="請在 /a 後面加上要摘要的文字。")]
+@handler.add(MessageEvent, message=AudioMessageContent)
+@profiled
+def handle_audio_message(event):
+    user_id = event.source.user_id
 
-                    )
+    # 檢查權限
+    if allowed_user_id and user_id != allowed_user_id:
+        deliver_message(user_id, "抱歉，您沒有權限使用此功能。", event.reply_token)
+        return
 
-                )
+    start_job(event, "audio")
 
-                return
+def get_drive_credentials():
+    """載入 Google Drive OAuth 憑證，過期時自動刷新；失敗時回傳 None"""
+    # 支援從環境變數讀取 JSON 字串
+    token_json_str = os.getenv('GOOGLE_TOKEN_JSON')
+    creds_json_str = os.getenv('GOOGLE_CREDENTIALS_JSON')
+    
+    token_file = os.getenv('GOOGLE_OAUTH_TOKEN', 'token.json')
+    credential_file = os.getenv('GOOGLE_OAUTH_CREDENTIALS', 'credentials.json')
 
+    creds = None
+    SCOPES = ['https://www.googleapis.com/auth/drive.file']
 
+    # 1. 優先嘗試從環境變數讀取 Token
+    if token_json_str:
+        try:
+            app.logger.info("Attempting to use GOOGLE_TOKEN_JSON from environment variables.")
+            token_info = json.loads(token_json_str)
+            creds = Credentials.from_authorized_user_info(token_info, SCOPES)
+        except Exception as e:
+            app.logger.error(f"Error parsing GOOGLE_TOKEN_JSON from env: {e}")
 
+    # 2. 如果沒讀到，嘗試從檔案讀取 Token
+    if not creds:
+        if os.path.exists(token_file):
             try:
-
-                # 產生標題與摘要
-
-                ai_title, ai_summary = get_ai_title_and_summary(content_to_summarize)
-
+                app.logger.info(f"Attempting to use token file: {token_file}")
+                creds = Credentials.from_authorized_user_file(token_file, SCOPES)
+            except Exception as e:
+                app.logger.error(f"Error loading token from file {token_file}: {e}")
+        else:
+            app.logger.warning(f"Token file {token_file} not found.")
+    
+    # 3. 檢查憑證是否有效，若過期嘗試刷新
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            try:
+                app.logger.info("Refreshing expired Google Drive token...")
+                creds.refresh(Request())
                 
+                # 如果是檔案模式，嘗試更新檔案
+                if os.path.exists(token_file):
+                    try:
+                        with open(token_file, 'w') as token:
+                            token.write(creds.to_json())
+                        app.logger.info(f"Successfully updated token file: {token_file}")
+                    except Exception as fe:
+                        app.logger.error(f"Failed to write updated token to file: {fe}")
+            except Exception as e:
+                app.logger.error(f"Error refreshing token: {e}")
+                return None
+        else:
+            msg = "Google Drive token is missing, invalid, or lacks refresh_token."
+            if not creds:
+                msg += " (No credentials could be loaded)"
+            app.logger.error(msg)
+            return None
 
-                # 儲存到 Notion
-
-                notion_status = ""
-
-                record_time = ""
-
-                if notion_token and notion_database_id and "your_" not in notion_token:
-
-                    success, time_str = save_to_notion_enhanced(
+    return creds
 
-                        content_to_summarize, 
+def upload_to_drive(file_path, original_filename, deadline=None):
+    """上傳檔案至 Google Drive"""
+    deadline = deadline or Deadline.unbounded()
+    drive_folder_id = os.getenv('GOOGLE_DRIVE_FOLDER_ID')
 
-                        ai_title, 
+    if not drive_folder_id:
+        app.logger.error("GOOGLE_DRIVE_FOLDER_ID is not set.")
+        return None
 
-                        ai_summary, 
+    creds = get_drive_credentials()
+    if not creds:
+        return None
 
-                        user_id, 
+    try:
+        file_metadata = {
+            'name': original_filename,
+            'parents': [drive_folder_id]
+        }
 
-                        type_name="文字摘要"
+        def create_file(timeout):
+            # 依剩餘預算設定 HTTP 逾時
+            service = build('drive', 'v3', http=AuthorizedHttp(creds, http=httplib2.Http(timeout=timeout)))
+            media = MediaFileUpload(file_path, resumable=True)
+            return service.files().create(
+                body=file_metadata,
+                media_body=media,
+                fields='id, webViewLink'
+            ).execute()
+
+        file = call_with_budget(deadline, 120, create_file, floor=5)
+        
+        return file.get('webViewLink')
+        
+    except Exception as e:
+        app.logger.error(f"Error uploading to Drive: {e}")
+        return None
 
-                    )
+# 影片與檔案以固定大小的區塊串流上傳，記憶體用量與檔案大小無關
+# Drive 可續傳上傳的區塊大小必須是 256 KiB 的倍數
+DRIVE_UPLOAD_CHUNK_SIZE = int(os.getenv('DRIVE_UPLOAD_CHUNK_SIZE', str(8 * 1024 * 1024))) // (256 * 1024) * (256 * 1024)
+DRIVE_UPLOAD_MAX_RETRIES = int(os.getenv('DRIVE_UPLOAD_MAX_RETRIES', '5'))
+LINE_CONTENT_READ_SIZE = 256 * 1024
+
+def stream_line_content(message_id, timeout=60):
+    """以串流方式逐塊讀取 LINE 訊息內容，不會把整個檔案載入記憶體"""
+    response = requests.get(
+        f"https://api-data.line.me/v2/bot/message/{message_id}/content",
+        headers={"Authorization": "Bearer " + channel_access_token},
+        stream=True,
+        timeout=timeout
+    )
+    response.raise_for_status()
+    try:
+        for piece in response.iter_content(chunk_size=LINE_CONTENT_READ_SIZE):
+            if piece:
+                yield piece
+    finally:
+        response.close()
+
+def drive_upload_offset(session_url, creds, total):
+    """詢問 Drive 已收到的位元組數，用於中斷後續傳"""
+    response = requests.put(
+        session_url,
+        headers={
+            "Authorization": "Bearer " + creds.token,
+            "Content-Range": f"bytes */{total if total is not None else '*'}"
+        },
+        timeout=30
+    )
+    if response.status_code in (200, 201):
+        return None
+    if response.status_code != 308:
+        # 工作階段已過期 (404/410) 等錯誤
+        response.raise_for_status()
+    byte_range = response.headers.get("Range")
+    return int(byte_range.rsplit("-", 1)[1]) + 1 if byte_range else 0
+
+def put_drive_chunk(session_url, creds, chunk, offset, total, timeout):
+    """上傳一個區塊，回傳 (Drive 已確認的位元組數, 完成時的檔案資訊)；暫時性錯誤會從已確認的位置重試"""
+    for attempt in range(DRIVE_UPLOAD_MAX_RETRIES):
+        if not creds.valid:
+            creds.refresh(Request())
+        if chunk:
+            content_range = f"bytes {offset}-{offset + len(chunk) - 1}/{total if total is not None else '*'}"
+        else:
+            content_range = f"bytes */{total}"
+        try:
+            response = requests.put(
+                session_url,
+                data=bytes(chunk),
+                headers={"Authorization": "Bearer " + creds.token, "Content-Range": content_range},
+                timeout=timeout
+            )
+            if response.status_code in (200, 201):
+                return offset + len(chunk), response.json()
+            if response.status_code == 308:
+                byte_range = response.headers.get("Range")
+                return (int(byte_range.rsplit("-", 1)[1]) + 1 if byte_range else 0), None
+            if response.status_code < 500 and response.status_code != 429:
+                response.raise_for_status()
+            app.logger.warning(f"Drive chunk upload returned {response.status_code}, retrying...")
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            app.logger.warning(f"Drive chunk upload interrupted: {e}, retrying...")
+
+        time.sleep(2 ** attempt)
+        try:
+            committed = drive_upload_offset(session_url, creds, total)
+        except requests.exceptions.RequestException:
+            continue
+        if committed is None:
+            # 最後一塊其實已經完成
+            return offset + len(chunk), None
+        if committed > offset:
+            return committed, None
+    raise RuntimeError(f"Drive chunk upload failed after {DRIVE_UPLOAD_MAX_RETRIES} attempts")
+
+def start_drive_session(creds, filename, mime_type, drive_folder_id):
+    response = requests.post(
+        "https://www.googleapis.com/upload/drive/v3/files?uploadType=resumable&fields=id,webViewLink",
+        headers={
+            "Authorization": "Bearer " + creds.token,
+            "Content-Type": "application/json; charset=UTF-8",
+            "X-Upload-Content-Type": mime_type
+        },
+        data=json.dumps({"name": filename, "parents": [drive_folder_id]}),
+        timeout=30
+    )
+    response.raise_for_status()
+    return response.headers["Location"]
+
+def resume_drive_session(session_url, creds):
+    """回傳 Drive 已收到的位元組數；工作階段已失效或已完成時回傳 None，改開新的工作階段"""
+    try:
+        return drive_upload_offset(session_url, creds, None)
+    except requests.exceptions.RequestException as e:
+        app.logger.warning(f"Drive upload session can no longer be resumed: {e}")
+        return None
 
-                    if success:
+def stream_to_drive(pieces, filename, mime_type, deadline=None, tee_path=None, session_url=None, on_progress=None):
+    """把串流內容以可續傳上傳寫入 Google Drive，回傳 webViewLink；
+    tee_path 有值時同時寫入本機檔案，供背景後製使用。
+    session_url 為先前中斷的上傳時從 Drive 已確認的位置續傳 (來源仍從頭讀取，已上傳的部分略過)；
+    on_progress(session_url, offset) 在開始與每個區塊確認後呼叫，讓呼叫端記錄續傳位置"""
+    deadline = deadline or Deadline.unbounded()
+    drive_folder_id = os.getenv('GOOGLE_DRIVE_FOLDER_ID')
+    if not drive_folder_id:
+        app.logger.error("GOOGLE_DRIVE_FOLDER_ID is not set.")
+        return None
 
-                        notion_status = "\n\n(已儲存摘要至 Notion)"
+    creds = get_drive_credentials()
+    if not creds:
+        return None
 
-                        record_time = time_str
+    offset = resume_drive_session(session_url, creds) if session_url else None
+    if offset is None:
+        session_url = start_drive_session(creds, filename, mime_type, drive_folder_id)
+        offset = 0
+    else:
+        app.logger.info(f"Resuming Drive upload of {filename} from byte {offset}")
+    if on_progress:
+        on_progress(session_url, offset)
+
+    buffer = bytearray()
+    skip = offset
+    tee_file = open(tee_path, "wb") if tee_path else None
+    try:
+        for piece in pieces:
+            if tee_file:
+                tee_file.write(piece)
+            if skip:
+                # Drive 已收到的部分不再上傳
+                dropped = min(skip, len(piece))
+                piece = piece[dropped:]
+                skip -= dropped
+            buffer += piece
+            # 區塊滿了就送出；Drive 未確認的部分留在 buffer 中下次重送
+            while len(buffer) >= DRIVE_UPLOAD_CHUNK_SIZE:
+                timeout = deadline.timeout(120, floor=10)
+                committed, _ = put_drive_chunk(session_url, creds, buffer[:DRIVE_UPLOAD_CHUNK_SIZE], offset, None, timeout)
+                if committed <= offset:
+                    raise RuntimeError("Drive upload made no progress")
+                del buffer[:committed - offset]
+                offset = committed
+                if on_progress:
+                    on_progress(session_url, offset)
+    finally:
+        if tee_file:
+            tee_file.close()
+
+    # 最後一塊帶上總大小以完成上傳
+    total = offset + len(buffer)
+    while True:
+        committed, file = put_drive_chunk(session_url, creds, buffer, offset, total, deadline.timeout(120, floor=10))
+        if file is not None:
+            return file.get("webViewLink")
+        if committed >= total:
+            # 伺服器已完成但回應遺失，以空內容再確認一次
+            buffer = bytearray()
+            offset = total
+            continue
+        if committed <= offset:
+            raise RuntimeError("Drive upload made no progress")
+        del buffer[:committed - offset]
+        offset = committed
 
-                    else:
+import base64
 
-                        notion_status = "\n\n(Notion 儲存失敗)"
+def encode_image(image_path):
+    with open(image_path, "rb") as image_file:
+        return base64.b64encode(image_file.read()).decode('utf-8')
 
-                
+def get_ai_image_title_and_description(image_paths, deadline=None):
+    """使用 GPT-4o 辨識一張或一組圖片的內容，回傳 (標題, 描述)"""
+    deadline = deadline or Deadline.unbounded()
+    if len(image_paths) == 1:
+        prompt = "請描述這張圖片的內容，並為它下一個精簡的標題(15字內)。格式範例：\n標題：[標題]\n內容：[詳細描述]"
+    else:
+        prompt = f"這是同一批傳送的 {len(image_paths)} 張圖片，請依序描述內容並整理共同主題，再為這組圖片下一個精簡的標題(15字內)。格式範例：\n標題：[標題]\n內容：[詳細描述]"
+    content = [{"type": "text", "text": prompt}]
+    for image_path in image_paths:
+        content.append({
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:image/jpeg;base64,{encode_image(image_path)}"
+            },
+        })
+    input_tokens = count_tokens(prompt) + VISION_TOKENS_PER_IMAGE * len(image_paths)
+
+    def request(candidate, timeout):
+        # 每多一張圖片多給一些輸出空間
+        max_tokens = min(model_router.output_cap(candidate, input_tokens) + 150 * (len(image_paths) - 1), 1500)
+        return openai_client.chat.completions.create(
+            model=candidate["model"],
+            messages=[
+                {
+                    "role": "user",
+                    "content": content,
+                }
+            ],
+            max_tokens=deadline.max_tokens(max_tokens),
+            timeout=timeout,
+        )
 
-                # 回覆使用者
+    # 每多一張圖片多給一些處理時間
+    response = model_router.call("vision", deadline, request, input_tokens, floor=5, extra_timeout=10 * len(image_paths))
+    ai_response = response.choices[0].message.content
 
-                if not record_time:
+    # 解析回應
+    ai_title = "圖片筆記"
+    ai_summary = ai_response
 
-                    tz = timezone(timedelta(hours=8))
+    if "標題：" in ai_response and "內容：" in ai_response:
+        parts = ai_response.split("內容：")
+        ai_title = parts[0].replace("標題：", "").strip()
+        ai_summary = parts[1].strip()
 
-                    record_time = datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
+    return ai_title, ai_summary
 
+def current_time_display():
+    # 設定台灣時間 UTC+8
+    tz = timezone(timedelta(hours=8))
+    return datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
 
-
-                reply_msg = f"【{ai_title}】\n\n{ai_summary}\n\n---\n原始文字：{content_to_summarize[:50]}...\n\n時間：{record_time}{notion_status}"
-
-                
-
+def deliver_message(user_id, text, reply_token=None):
+    """優先使用 reply token 回覆；沒有 token 或 token 已失效時改用 push 訊息"""
+    # LINE 文字訊息上限 5000 字
+    text = text[:5000]
+    with ApiClient(configuration) as api_client:
+        line_bot_api = MessagingApi(api_client)
+        if reply_token:
+            try:
                 line_bot_api.reply_message(
-
                     ReplyMessageRequest(
-
-                        reply_token=event.reply_token,
-
-                        messages=[TextMessage(text=reply_msg)]
-
+                        reply_token=reply_token,
+                        messages=[TextMessage(text=text)]
                     )
-
                 )
-
+                return
             except Exception as e:
+                app.logger.warning(f"Reply failed, falling back to push message: {e}")
+        line_bot_api.push_message(
+            PushMessageRequest(
+                to=user_id,
+                messages=[TextMessage(text=text)]
+            )
+        )
 
-                app.logger.error(f"Error processing text summary: {e}")
-
-                line_bot_api.reply_message(
-
-                    ReplyMessageRequest(
-
-                        reply_token=event.reply_token,
-
-                        messages=[TextMessage(text="抱歉，摘要處理失敗。")]
-
-                    )
+def download_line_content(message_id, suffix):
+    """下載 LINE 訊息內容到工作資料夾，重啟後仍可使用"""
+    with ApiClient(configuration) as api_client:
+        line_bot_blob_api = MessagingApiBlob(api_client)
+        message_content = line_bot_blob_api.get_message_content(message_id=message_id)
+
+    file_path = os.path.join(JOB_DATA_DIR, f"{message_id}{suffix}")
+    with open(file_path, "wb") as f:
+        f.write(message_content)
+    return file_path
+
+def save_job_to_notion(job, text, type_name="語音筆記", url=None, saved_status="\n\n(已儲存摘要至 Notion)", deadline=None):
+    """將工作的摘要存入 Notion 並記錄 saved 階段"""
+    data = job["data"]
+    notion_status = ""
+    record_time = ""
+    if notion_token and notion_database_id and "your_" not in notion_token:
+        success, time_str = save_to_notion_enhanced(
+            text,
+            data["ai_title"],
+            data["ai_summary"],
+            job["user_id"],
+            type_name=type_name,
+            url=url,
+            deadline=deadline
+        )
+        if success:
+            notion_status = saved_status
+            record_time = time_str
+        else:
+            notion_status = "\n\n(Notion 儲存失敗)"
+    journal_advance(job, "saved", notion_status=notion_status, record_time=record_time)
+
+def run_save_stage(job, save, deadline):
+    """執行 saved 階段；剩餘時間不足時先回覆使用者，Notion 改在回覆後於背景儲存"""
+    if notion_token and notion_database_id and "your_" not in notion_token:
+        if deadline.below(DEGRADE_DEFER_NOTION_BELOW, "defer_notion"):
+            job["after_reply"] = save
+            journal_advance(job, notion_status="\n\n(稍後於背景儲存至 Notion)", record_time="")
+            return
+    save(deadline)
+
+def url_type_name(url):
+    if "facebook.com" in url or "fb.watch" in url:
+        return "fb"
+    elif "threads.net" in url:
+        return "threads"
+    return "網頁摘要"
+
+def process_text_job(job, deadline):
+    data = job["data"]
+    content_to_summarize = data["text"]
+    if data.get("digest_mode") == "only":
+        return digest_ack(job)
+
+    # 1. 產生標題與摘要
+    if not stage_done(job, "summarized"):
+        ai_title, ai_summary = get_ai_title_and_summary(content_to_summarize, deadline)
+        journal_advance(job, "summarized", ai_title=ai_title, ai_summary=ai_summary)
+
+    # 2. 儲存到 Notion
+    if not stage_done(job, "saved"):
+        run_save_stage(job, lambda d: save_job_to_notion(job, content_to_summarize, type_name="文字摘要", deadline=d), deadline)
+
+    # 3. 回覆使用者
+    record_time = data["record_time"] or current_time_display()
+    source_label = f"原始文字 (合併 {data['note_count']} 則)" if data.get("note_count", 1) > 1 else "原始文字"
+    return f"【{data['ai_title']}】\n\n{data['ai_summary']}\n\n---\n{source_label}：{content_to_summarize[:50]}...\n\n時間：{record_time}{data['notion_status']}"
+
+def process_url_job(job, deadline):
+    data = job["data"]
+    url = data["url"]
+
+    # 1. 辨別類型
+    type_name = url_type_name(url)
+
+    # 2. 爬取網頁內容
+    if not stage_done(job, "downloaded"):
+        web_content = fetch_url_content(url, deadline)
+        if not web_content:
+            return "無法讀取網頁內容，可能是網站有防護或連結無效。"
+        journal_advance(job, "downloaded", web_content=web_content)
+    if data.get("digest_mode") == "only":
+        return digest_ack(job)
+
+    # 3. 產生標題與摘要
+    if not stage_done(job, "summarized"):
+        ai_title, ai_summary = get_ai_title_and_summary(data["web_content"], deadline)
+        journal_advance(job, "summarized", ai_title=ai_title, ai_summary=ai_summary)
+
+    # 4. 儲存到 Notion (包含 URL 與類型)
+    if not stage_done(job, "saved"):
+        run_save_stage(
+            job,
+            lambda d: save_job_to_notion(job, data["web_content"], type_name=type_name, url=url, deadline=d),
+            deadline
+        )
 
+    # 5. 回覆使用者
+    record_time = data["record_time"] or current_time_display()
+    return f"【{data['ai_title']}】({type_name})\n\n{data['ai_summary']}\n\n---\n來源：{url}\n\n時間：{record_time}{data['notion_status']}"
+
+def process_multi_url_job(job, deadline):
+    data = job["data"]
+    links = data.get("links") or [{"url": url, "type_name": url_type_name(url)} for url in data["urls"]]
+
+    # 1. 同時爬取所有網址，總耗時約等於最慢的那一個
+    if not stage_done(job, "downloaded"):
+        contents = map_concurrently(lambda link: fetch_url_content(link["url"], deadline), links)
+        for link, content in zip(links, contents):
+            link["content"] = content
+        if not any(link["content"] for link in links):
+            return "無法讀取網頁內容，可能是網站有防護或連結無效。"
+        journal_advance(job, "downloaded", links=links)
+    if data.get("digest_mode") == "only":
+        return digest_ack(job)
+
+    readable = [link for link in links if link.get("content")]
+
+    # 2. 逐一產生標題與摘要，再彙整成一份綜合摘要
+    if not stage_done(job, "summarized"):
+        results = map_concurrently(lambda link: get_ai_title_and_summary(link["content"], deadline), readable)
+        for link, (ai_title, ai_summary) in zip(readable, results):
+            link["ai_title"] = ai_title
+            link["ai_summary"] = ai_summary
+        digest = get_ai_digest(readable, data.get("note"), deadline) if len(readable) > 1 else readable[0]["ai_summary"]
+        journal_advance(job, "summarized", links=links, digest=digest)
+
+    # 3. 每個連結各自存成一筆 Notion 記錄
+    def save_links(save_deadline):
+        notion_status = ""
+        record_time = ""
+        if notion_token and notion_database_id and "your_" not in notion_token:
+            results = map_concurrently(
+                lambda link: save_to_notion_enhanced(
+                    link["content"],
+                    link["ai_title"],
+                    link["ai_summary"],
+                    job["user_id"],
+                    type_name=link["type_name"],
+                    url=link["url"],
+                    deadline=save_deadline
+                ),
+                readable
+            )
+            saved_count = sum(1 for success, _ in results if success)
+            record_time = next((time_str for success, time_str in results if success), "")
+            if saved_count == len(readable):
+                notion_status = "\n\n(已儲存摘要至 Notion)"
+            else:
+                notion_status = f"\n\n(Notion 儲存 {saved_count}/{len(readable)} 筆成功)"
+        journal_advance(job, "saved", notion_status=notion_status, record_time=record_time)
+
+    if not stage_done(job, "saved"):
+        run_save_stage(job, save_links, deadline)
+
+    # 4. 合併成一則回覆
+    record_time = data["record_time"] or current_time_display()
+    sections = [
+        f"{i}. 【{link['ai_title']}】({link['type_name']})\n{link['ai_summary']}\n來源：{link['url']}"
+        for i, link in enumerate(readable, 1)
+    ]
+    failed = [link["url"] for link in links if not link.get("content")]
+    if failed:
+        sections.append("無法讀取：\n" + "\n".join(failed))
+    return f"【綜合摘要】({len(readable)} 則連結)\n\n{data['digest']}\n\n---\n" + "\n\n".join(sections) + f"\n\n時間：{record_time}{data['notion_status']}"
+
+def process_audio_job(job, deadline):
+    data = job["data"]
+
+    # 0. 取得音訊內容（換到別的機器續跑時檔案可能不存在，需重新下載）
+    if not stage_done(job, "transcribed") and not os.path.exists(data.get("file_path", "")):
+        file_path = download_line_content(job["id"], ".m4a")
+        journal_advance(job, "downloaded", file_path=file_path)
+
+    # 1. 使用 OpenAI Whisper 轉錄
+    if not stage_done(job, "transcribed"):
+        def transcribe(candidate, timeout):
+            with open(data["file_path"], "rb") as audio_file:
+                return openai_client.audio.transcriptions.create(
+                    model=candidate["model"],
+                    file=audio_file,
+                    response_format="text",
+                    timeout=timeout
                 )
 
+        transcript = model_router.call("transcription", deadline, transcribe, floor=10)
+        raw_text = transcript if isinstance(transcript, str) else transcript.text
+        journal_advance(job, "transcribed", transcript=raw_text)
 
+    raw_text = data["transcript"]
+    if data.get("digest_mode") == "only":
+        return digest_ack(job)
 
-        elif text.startswith("http://") or text.startswith("https://"):
-
-            # 處理網址摘要
-
-            url = text
-
-            try:
-
-                # 1. 辨別類型
-
-                type_name = "網頁摘要"
-
-                if "facebook.com" in url or "fb.watch" in url:
-
-                    type_name = "fb"
-
-                elif "threads.net" in url:
-
-                    type_name = "threads"
-
+    # 2. 使用 OpenAI 生成標題與摘要
+    if not stage_done(job, "summarized"):
+        ai_title, ai_summary = get_ai_title_and_summary(raw_text, deadline)
+        journal_advance(job, "summarized", ai_title=ai_title, ai_summary=ai_summary)
 
+    # 3. 儲存到 Notion
+    if not stage_done(job, "saved"):
+        run_save_stage(job, lambda d: save_job_to_notion(job, raw_text, deadline=d), deadline)
 
-                # 2. 爬取網頁內容
+    # 4. 回覆使用者
+    return f"【{data['ai_title']}】\n\n{data['ai_summary']}\n\n---\n原始語音：{raw_text}\n\n時間：{data['record_time']}{data['notion_status']}"
 
-                web_content = fetch_url_content(url)
+def process_image_job(job, deadline):
+    data = job["data"]
 
-                
-
-                if not web_content:
-
-                    line_bot_api.reply_message(
-
-                        ReplyMessageRequest(
-
-                            reply_token=event.reply_token,
-
-                            messages=[TextMessage(text="無法讀取網頁內容，可能是網站有防護或連結無效。")]
-
-                        )
-
-                    )
+    # 取得圖片內容
+    if not stage_done(job, "summarized") and not os.path.exists(data.get("file_path", "")):
+        file_path = download_line_content(job["id"], ".jpg")
+        journal_advance(job, "downloaded", file_path=file_path)
 
-                    return
+    # 上傳至 Google Drive（連結存入日誌，續跑時不會重複上傳）
+    if not data.get("drive_link"):
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = f"line_image_{timestamp}.jpg"
+        drive_link = upload_to_drive(data["file_path"], filename, deadline)
+        if not drive_link:
+            return "圖片上傳失敗，請檢查後端日誌或確認授權狀態。"
+        journal_advance(job, drive_link=drive_link)
 
+    drive_link = data["drive_link"]
 
+    # 使用 GPT-4o 辨識圖片內容
+    if not stage_done(job, "summarized"):
+        try:
+            ai_title, ai_summary = get_ai_image_title_and_description([data["file_path"]], deadline)
+        except Exception as ai_e:
+            app.logger.error(f"Error in AI vision processing: {ai_e}")
+            ai_title = "圖片筆記"
+            ai_summary = f"無法辨識圖片內容。Drive 連結: {drive_link}"
+        journal_advance(job, "summarized", ai_title=ai_title, ai_summary=ai_summary)
+
+    # 儲存至 Notion
+    if not stage_done(job, "saved"):
+        run_save_stage(
+            job,
+            lambda d: save_job_to_notion(
+                job,
+                f"圖片連結: {drive_link}\n\nAI 描述: {data['ai_summary']}",
+                type_name="圖片",
+                url=drive_link,
+                saved_status="\n\n(已記錄至 Notion)",
+                deadline=d
+            ),
+            deadline
+        )
 
-                # 3. 產生標題與摘要
-
-                ai_title, ai_summary = get_ai_title_and_summary(web_content)
-
-                
-
-                # 4. 儲存到 Notion (包含 URL 與類型)
-
-                notion_status = ""
-
-                record_time = ""
-
-                if notion_token and notion_database_id and "your_" not in notion_token:
-
-                    success, time_str = save_to_notion_enhanced(
-
-                        web_content, 
-
-                        ai_title, 
-
-                        ai_summary, 
-
-                        user_id, 
-
-                        type_name=type_name,
-
-                        url=url
-
-                    )
-
-                    if success:
-
-                        notion_status = "\n\n(已儲存摘要至 Notion)"
-
-                        record_time = time_str
-
-                    else:
-
-                        notion_status = "\n\n(Notion 儲存失敗)"
-
-                
-
-                # 5. 回覆使用者
-
-                if not record_time:
-
-                    tz = timezone(timedelta(hours=8))
-
-                    record_time = datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
-
-
-
-                reply_msg = f"【{ai_title}】({type_name})\n\n{ai_summary}\n\n---\n來源：{url}\n\n時間：{record_time}{notion_status}"
-
-                
-
-                line_bot_api.reply_message(
-
-                    ReplyMessageRequest(
-
-                        reply_token=event.reply_token,
-
-                        messages=[TextMessage(text=reply_msg)]
-
-                    )
-
-                )
-
-                
-
-            except Exception as e:
-
-                app.logger.error(f"Error processing URL summary: {e}")
-
-                line_bot_api.reply_message(
-
-                    ReplyMessageRequest(
-
-                        reply_token=event.reply_token,
-
-                        messages=[TextMessage(text="抱歉，網頁摘要處理失敗。")]
+    record_time = data["record_time"] or current_time_display()
+    return f"【{data['ai_title']}】\n\n{data['ai_summary']}\n\n---\n連結：{drive_link}\n時間：{record_time}{data['notion_status']}"
+
+def process_image_batch_job(job, deadline):
+    """同一批連續傳送的圖片：一次視覺辨識、一筆 Notion 記錄、一則回覆"""
+    data = job["data"]
+    message_ids = data["message_ids"]
+
+    # 1. 並行下載並上傳每張圖片至 Google Drive
+    if not data.get("drive_links"):
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+        def download_and_upload(indexed):
+            i, message_id = indexed
+            file_path = os.path.join(JOB_DATA_DIR, f"{message_id}.jpg")
+            if not os.path.exists(file_path):
+                file_path = download_line_content(message_id, ".jpg")
+            return file_path, upload_to_drive(file_path, f"line_image_{timestamp}_{i}.jpg", deadline)
+
+        results = map_concurrently(download_and_upload, list(enumerate(message_ids, 1)))
+        file_paths = [file_path for file_path, _ in results]
+        if not all(drive_link for _, drive_link in results):
+            journal_advance(job, file_paths=file_paths)
+            return "圖片上傳失敗，請檢查後端日誌或確認授權狀態。"
+        journal_advance(job, "downloaded", file_paths=file_paths, drive_links=[drive_link for _, drive_link in results])
+
+    drive_links = data["drive_links"]
+    links_text = "\n".join(f"{i}. {link}" for i, link in enumerate(drive_links, 1))
+
+    # 2. 一次送出所有圖片給 GPT-4o（續跑時檔案可能不存在，需重新下載）
+    if not stage_done(job, "summarized"):
+        file_paths = [
+            path if os.path.exists(path) else download_line_content(message_id, ".jpg")
+            for path, message_id in zip(data["file_paths"], message_ids)
+        ]
+        try:
+            ai_title, ai_summary = get_ai_image_title_and_description(file_paths, deadline)
+        except Exception as ai_e:
+            app.logger.error(f"Error in AI vision processing: {ai_e}")
+            ai_title = "圖片筆記"
+            ai_summary = f"無法辨識圖片內容。Drive 連結:\n{links_text}"
+        journal_advance(job, "summarized", ai_title=ai_title, ai_summary=ai_summary)
+
+    # 3. 整批存成一筆 Notion 記錄
+    if not stage_done(job, "saved"):
+        run_save_stage(
+            job,
+            lambda d: save_job_to_notion(
+                job,
+                f"圖片連結 ({len(drive_links)} 張):\n{links_text}\n\nAI 描述: {data['ai_summary']}",
+                type_name="圖片",
+                url=drive_links[0],
+                saved_status="\n\n(已記錄至 Notion)",
+                deadline=d
+            ),
+            deadline
+        )
 
+    record_time = data["record_time"] or current_time_display()
+    return f"【{data['ai_title']}】({len(drive_links)} 張圖片)\n\n{data['ai_summary']}\n\n---\n連結：\n{links_text}\n時間：{record_time}{data['notion_status']}"
+
+# 影片與文件的背景後製：擷取音軌轉文字或擷取文件文字，摘要後存入 Notion
+MEDIA_POSTPROCESS_ENABLED = os.getenv('MEDIA_POSTPROCESS_ENABLED', 'false').lower() == 'true'
+# 每段音訊的長度 (秒)，64 kbps 下約 10 MB，低於 Whisper 的 25 MB 上限
+WHISPER_SEGMENT_SECONDS = int(os.getenv('WHISPER_SEGMENT_SECONDS', '1200'))
+MEDIA_EXTENSIONS = {".mp4", ".mov", ".m4v", ".webm", ".mkv", ".m4a", ".mp3", ".wav", ".aac", ".ogg"}
+TEXT_EXTENSIONS = {".txt", ".md", ".csv"}
+MEDIA_LABELS = {"video": "影片", "file": "檔案"}
+
+def media_extension(job):
+    if job["kind"] == "video":
+        return ".mp4"
+    return os.path.splitext(job["data"].get("file_name", ""))[1].lower()
+
+def wants_postprocess(job):
+    if not MEDIA_POSTPROCESS_ENABLED:
+        return False
+    ext = media_extension(job)
+    if ext in MEDIA_EXTENSIONS:
+        return shutil.which("ffmpeg") is not None
+    if ext == ".pdf":
+        return PdfReader is not None
+    return ext == ".docx" or ext in TEXT_EXTENSIONS
+
+def wait_for_line_transcoding(message_id, wait=60):
+    """LINE 影片需先轉檔完成才能下載內容"""
+    give_up_at = time.time() + wait
+    while time.time() < give_up_at:
+        response = requests.get(
+            f"https://api-data.line.me/v2/bot/message/{message_id}/content/transcoding",
+            headers={"Authorization": "Bearer " + channel_access_token},
+            timeout=10
+        )
+        status = response.json().get("status") if response.ok else None
+        if status == "succeeded":
+            return
+        if status == "failed":
+            raise RuntimeError(f"LINE transcoding failed for message {message_id}")
+        time.sleep(2)
+    raise RuntimeError(f"LINE transcoding did not finish for message {message_id}")
+
+def transcribe_media(file_path):
+    """用 ffmpeg 取出單聲道音軌並分段，逐段以 Whisper 轉成文字"""
+    segment_dir = tempfile.mkdtemp(dir=JOB_DATA_DIR)
+    try:
+        subprocess.run(
+            [
+                "ffmpeg", "-nostdin", "-loglevel", "error", "-i", file_path,
+                "-vn", "-ac", "1", "-ar", "16000", "-c:a", "aac", "-b:a", "64k",
+                "-f", "segment", "-segment_time", str(WHISPER_SEGMENT_SECONDS),
+                os.path.join(segment_dir, "part%03d.m4a")
+            ],
+            check=True,
+            timeout=1800
+        )
+        texts = []
+        for name in sorted(os.listdir(segment_dir)):
+            def transcribe(candidate, timeout):
+                with open(os.path.join(segment_dir, name), "rb") as audio_file:
+                    return openai_client.audio.transcriptions.create(
+                        model=candidate["model"],
+                        file=audio_file,
+                        response_format="text",
+                        timeout=timeout
                     )
 
-                )
-
+            transcript = model_router.call("transcription", Deadline.unbounded(), transcribe)
+            texts.append(transcript if isinstance(transcript, str) else transcript.text)
+        return "\n".join(texts)
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
+
+def extract_document_text(file_path, ext):
+    if ext == ".pdf":
+        reader = PdfReader(file_path)
+        return "\n".join(page.extract_text() or "" for page in reader.pages)
+    if ext == ".docx":
+        # DOCX 是 zip 包裝的 XML，直接讀取段落文字
+        namespace = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+        with zipfile.ZipFile(file_path) as docx:
+            root = ET.fromstring(docx.read("word/document.xml"))
+        paragraphs = ("".join(node.text or "" for node in p.iter(f"{namespace}t")) for p in root.iter(f"{namespace}p"))
+        return "\n".join(p for p in paragraphs if p)
+    with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+        return f.read()
+
+def postprocess_media_job(job, deadline):
+    """背景擷取內容、摘要並存入 Notion，完成後以 push 通知使用者"""
+    data = job["data"]
+    ext = media_extension(job)
+    label = MEDIA_LABELS[job["kind"]]
+
+    # 1. 擷取文字（換到別的機器續跑時需重新下載原始檔）
+    if not stage_done(job, "transcribed"):
+        file_path = data.get("file_path")
+        if not file_path or not os.path.exists(file_path):
+            file_path = os.path.join(JOB_DATA_DIR, f"{job['id']}{ext}")
+            with open(file_path, "wb") as f:
+                for piece in stream_line_content(job["id"]):
+                    f.write(piece)
+            journal_advance(job, file_path=file_path)
+        if ext in MEDIA_EXTENSIONS:
+            text = transcribe_media(file_path)
+        else:
+            text = extract_document_text(file_path, ext)
+        # 限制長度，避免 Token 爆量
+        journal_advance(job, "transcribed", transcript=truncate_to_tokens(text, SOURCE_MAX_TOKENS))
 
+    raw_text = data["transcript"]
+    if not raw_text.strip():
+        deliver_message(job["user_id"], f"無法從{label}擷取到文字內容。\n\n連結：{data['drive_link']}")
+        return
 
+    # 2. 產生標題與摘要
+    if not stage_done(job, "summarized"):
+        ai_title, ai_summary = get_ai_title_and_summary(raw_text, deadline)
+        journal_advance(job, "summarized", ai_title=ai_title, ai_summary=ai_summary)
+
+    # 3. 儲存到 Notion
+    if not stage_done(job, "saved"):
+        save_job_to_notion(job, raw_text, type_name=label, url=data["drive_link"], deadline=deadline)
+
+    # 4. 通知使用者
+    record_time = data["record_time"] or current_time_display()
+    deliver_message(
+        job["user_id"],
+        f"【{data['ai_title']}】\n\n{data['ai_summary']}\n\n---\n連結：{data['drive_link']}\n時間：{record_time}{data['notion_status']}"
+    )
+
+def upload_media_job(job, deadline):
+    """邊從 LINE 下載邊以區塊上傳至 Google Drive，完成後以 push 通知；需要後製時接著擷取內容並摘要"""
+    data = job["data"]
+    label = MEDIA_LABELS[job["kind"]]
+
+    # 需要後製時同時寫入暫存檔
+    if not data.get("drive_link"):
+        if job["kind"] == "video":
+            wait_for_line_transcoding(job["id"])
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = data.get("file_name") or f"line_video_{timestamp}.mp4"
+        mime_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        tee_path = os.path.join(JOB_DATA_DIR, f"{job['id']}{media_extension(job)}") if wants_postprocess(job) else None
+        drive_link = stream_to_drive(
+            stream_line_content(job["id"]), filename, mime_type, deadline, tee_path,
+            session_url=data.get("drive_session"),
+            on_progress=lambda session_url, offset: journal_advance(job, drive_session=session_url, drive_offset=offset)
+        )
+        if not drive_link:
+            deliver_message(job["user_id"], f"{label}上傳失敗，請檢查後端日誌或確認授權狀態。")
+            return
+        if tee_path:
+            journal_advance(job, "downloaded", drive_link=drive_link, file_path=tee_path)
         else:
+            journal_advance(job, "downloaded", drive_link=drive_link)
+
+    if not data.get("upload_notified"):
+        message = f"已將{label}上傳至 Google Drive\n\n連結：{data['drive_link']}"
+        if wants_postprocess(job):
+            message += "\n\n(正在背景擷取內容並摘要，完成後會再通知您)"
+        deliver_message(job["user_id"], message)
+        journal_advance(job, upload_notified=True)
+
+    if wants_postprocess(job):
+        postprocess_media_job(job, deadline)
+
+def process_media_job(job, deadline):
+    # 等待 LINE 轉檔與上傳大檔可能超過 worker 逾時，webhook 內只回覆已收到，上傳改在回覆後於背景進行
+    if job["data"].get("reply_sent"):
+        # 續跑：已回覆過，直接完成上傳與後製
+        upload_media_job(job, deadline)
+        return None
+    job["after_reply"] = lambda d: upload_media_job(job, d)
+    return f"已收到{MEDIA_LABELS[job['kind']]}，正在背景上傳至 Google Drive，完成後會再通知您。"
+
+JOB_PROCESSORS = {
+    "text": process_text_job,
+    "url": process_url_job,
+    "urls": process_multi_url_job,
+    "audio": process_audio_job,
+    "image": process_image_job,
+    "image_batch": process_image_batch_job,
+    "video": process_media_job,
+    "file": process_media_job,
+}
+
+JOB_FAILURE_MESSAGES = {
+    "text": "抱歉，摘要處理失敗。",
+    "url": "抱歉，網頁摘要處理失敗。",
+    "urls": "抱歉，網頁摘要處理失敗。",
+    "audio": "抱歉，語音處理失敗。",
+    "image": "抱歉，圖片處理失敗。",
+    "image_batch": "抱歉，圖片處理失敗。",
+    "video": "抱歉，影片處理失敗。",
+    "file": "抱歉，檔案處理失敗。",
+}
+
+def cleanup_job_files(job):
+    file_paths = job["data"].get("file_paths") or [job["data"].get("file_path")]
+    for file_path in file_paths:
+        if file_path and os.path.exists(file_path):
+            os.remove(file_path)
+
+@tracked_job
+def finish_after_reply(job, work):
+    """回覆之後在背景完成延後的工作（Notion 儲存、影片與文件的後製）"""
+    try:
+        work(Deadline.unbounded())
+        journal_advance(job, "replied")
+    except Exception as e:
+        app.logger.error(f"Error in background work for job {job['id']}: {e}")
+        journal_fail(job, str(e))
+        deliver_message(job["user_id"], JOB_FAILURE_MESSAGES.get(job["kind"], "抱歉，處理失敗。"))
+    finally:
+        cleanup_job_files(job)
+
+@tracked_job
+def run_job(job, reply_token=None, deadline=None):
+    """從工作目前的階段執行到回覆為止；reply_token 為 None 時（例如重啟續跑）以 push 送出結果"""
+    deadline = deadline or Deadline.unbounded()
+    try:
+        reply_msg = JOB_PROCESSORS[job["kind"]](job, deadline)
+        if reply_msg and job["data"].get("skipped_urls"):
+            reply_msg += f"\n\n(一則訊息最多處理 {MAX_URLS_PER_MESSAGE} 個連結，另有 {job['data']['skipped_urls']} 個未處理)"
+        if not job["data"].get("reply_sent"):
+            # 來不及使用 reply token 時直接改用 push
+            deliver_message(job["user_id"], reply_msg, None if deadline.push_only() else reply_token)
+        if job["data"].get("digest_mode") in ("on", "only"):
+            record_digest_notes(job)
+        if deadline.degradations:
+            app.logger.info(f"Job {job['id']} finished with degradations: {deadline.degradations}")
+            job["data"]["degradations"] = deadline.degradations
+
+        after_reply = job.pop("after_reply", None)
+        if after_reply:
+            journal_advance(job, reply_sent=True)
+            threading.Thread(target=finish_after_reply, args=(job, after_reply), daemon=True).start()
+            return
+        journal_advance(job, "replied")
+        cleanup_job_files(job)
+    except Exception as e:
+        app.logger.error(f"Error processing {job['kind']} job {job['id']}: {e}")
+        journal_fail(job, str(e))
+        cleanup_job_files(job)
+        deliver_message(
+            job["user_id"],
+            JOB_FAILURE_MESSAGES.get(job["kind"], "抱歉，處理失敗。"),
+            None if deadline.push_only() else reply_token
+        )
 
-            # 回覆一樣的訊息 (Echo)
+def accept_event(event):
+    """webhook 事件去重與限流；回傳 False 表示此事件不需處理"""
+    # 重送的事件可能落在另一個 worker 或機器上，先以共享狀態去重
+    if not state_backend.set_if_absent(f"event:{event.webhook_event_id}", _worker_id(), ttl=86400):
+        app.logger.info(f"Webhook event {event.webhook_event_id} was already accepted elsewhere, skipping.")
+        return False
+    if is_rate_limited(event.source.user_id):
+        deliver_message(event.source.user_id, "訊息太多了，請稍後再試。", event.reply_token)
+        return False
+    return True
+
+def start_job(event, kind, data=None):
+    """登記 webhook 事件為工作並立即執行；LINE 重送的事件會被忽略"""
+    if accept_event(event):
+        launch_job(event, kind, data)
+
+def with_digest_flags(user_id, kind, data):
+    if kind in DIGEST_KINDS:
+        mode = digest_mode(user_id)
+        if mode != "off":
+            # 多連結工作的 data["digest"] 是綜合摘要文字，模式另存於 digest_mode
+            return dict(data or {}, digest_mode=mode)
+    return data
+
+def launch_job(event, kind, data=None):
+    """在工作執行緒中執行工作；webhook 請求最多等到預算用完，剩下的部分在背景完成並以 push 送出"""
+    job = journal_accept(event.message.id, event.source.user_id, kind, with_digest_flags(event.source.user_id, kind, data))
+    if job is None:
+        app.logger.info(f"Message {event.message.id} is already journaled, skipping redelivery.")
+        return
+    deadline = Deadline.from_event(event)
+    worker = threading.Thread(
+        target=run_profiled, args=(f"{kind}_job", event, lambda: run_job(job, event.reply_token, deadline)), daemon=True
+    )
+    worker.start()
+    worker.join(max(0, deadline.remaining()))
+    if worker.is_alive():
+        deadline.degrade("push_delivery")
+        app.logger.warning(f"Job {job['id']} is still running after the reply budget, finishing it in the background.")
+
+def build_image_burst(members):
+    members.sort(key=lambda job: job["data"].get("index") or 0)
+    if len(members) == 1:
+        return "image", {}
+    return "image_batch", {"message_ids": [job["id"] for job in members]}
+
+def build_note_burst(members):
+    notes = [job["data"]["text"] for job in members]
+    return "text", {"text": "\n\n".join(notes), "note_count": len(notes)}
+
+# 依成員的 kind 決定整批合併後的工作
+BURST_BUILDERS = {
+    "image": build_image_burst,
+    "text": build_note_burst,
+}
+
+def run_pending_group(members, reply_token=None, deadline=None):
+    """把仍待合併的成員併成一個工作後執行整批；全部已被其他 leader 或復原流程收下時略過"""
+    job = journal_merge_pending(members, lambda jobs: BURST_BUILDERS[jobs[0]["kind"]](jobs))
+    if job is None:
+        app.logger.info(f"Burst members {[job_id for job_id, _ in members]} are no longer pending, skipping.")
+        return
+    run_job(job, reply_token, deadline)
 
-            line_bot_api.reply_message(
+def accept_burst_item(event, kind, group_key, data, window, expected=None):
+    """先把訊息登記為待合併 (pending) 的工作，再於背景等待同組的其他訊息；
+    leader 收齊後合併成一個工作執行，中途停機時由復原流程依工作日誌重建整批"""
+    if not accept_event(event):
+        return
+    user_id = event.source.user_id
+    job = journal_accept(
+        event.message.id, user_id, kind,
+        with_digest_flags(user_id, kind, dict(data, burst_group=group_key)),
+        stage="pending",
+        lease_seconds=BURST_MAX_WAIT_SECONDS + BURST_PENDING_GRACE_SECONDS
+    )
+    if job is None:
+        app.logger.info(f"Message {event.message.id} is already journaled, skipping redelivery.")
+        return
 
-                ReplyMessageRequest(
+    def work():
+        # 工作日誌是本機的 SQLite，佇列在 Redis 上時以主機區分群組，leader 才找得到每個成員的記錄
+        batch = coalesce_burst(f"{socket.gethostname()}:{group_key}", {"message_id": job["id"]}, window, expected)
+        if batch:
+            members = [(message_id, 0) for message_id in dict.fromkeys(item["message_id"] for item in batch)]
+            run_pending_group(members, event.reply_token, Deadline.from_event(event))
 
-                    reply_token=event.reply_token,
+    def run():
+        try:
+            run_profiled(f"{kind}_burst", event, work)
+        except Exception as e:
+            app.logger.error(f"Burst handling for {group_key} failed, leaving it to recovery: {e}")
 
-                    messages=[TextMessage(text=event.message.text)]
+    threading.Thread(target=run, daemon=True).start()
 
-                )
+JOB_RECOVERY_WORKERS = int(os.getenv('JOB_RECOVERY_WORKERS', '4'))
+recovery_pool = ThreadPoolExecutor(max_workers=JOB_RECOVERY_WORKERS, thread_name_prefix="recovery")
+recovery_futures = set()
 
-            )
+def submit_recovery(func, *args):
+    """在復原執行緒池中續跑工作，耗時的工作不會卡住下一輪的認領"""
+    def run():
+        try:
+            func(*args)
+        except Exception as e:
+            app.logger.error(f"Recovered {func.__name__} failed: {e}")
 
-@handler.add(MessageEvent, message=AudioMessageContent)
-def handle_audio_message(event):
-    user_id = event.source.user_id
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        
-        # 檢查權限
-        if allowed_user_id and user_id != allowed_user_id:
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="抱歉，您沒有權限使用此功能。")]
-                )
-            )
-            return
+    future = recovery_pool.submit(run)
+    recovery_futures.add(future)
+    future.add_done_callback(recovery_futures.discard)
 
-        line_bot_blob_api = MessagingApiBlob(api_client)
-        
-        # 取得音訊內容
-        message_content = line_bot_blob_api.get_message_content(message_id=event.message.id)
-        
-        # 儲存到暫存檔
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.m4a') as tf:
-            tf.write(message_content)
-            temp_file_path = tf.name
+def recover_unfinished_jobs():
+    """續跑因重啟或當機中斷的工作，並以 push 訊息送出結果；只認領執行緒池還有空位的數量"""
+    capacity = JOB_RECOVERY_WORKERS - len(recovery_futures)
+    if capacity <= 0:
+        return
+    pending_groups = {}
+    for job in journal_claim_stale(limit=capacity):
+        if job["attempts"] > JOB_MAX_ATTEMPTS:
+            app.logger.error(f"Job {job['id']} exceeded {JOB_MAX_ATTEMPTS} recovery attempts, giving up.")
+            journal_fail(job, "too many recovery attempts")
+            cleanup_job_files(job)
+            continue
+        if job["stage"] == "pending":
+            pending_groups.setdefault(job["data"]["burst_group"], []).append(job)
+            continue
+        app.logger.info(f"Resuming {job['kind']} job {job['id']} from stage '{job['stage']}'")
+        submit_recovery(run_job, job)
+
+    # 合併視窗中斷的批次：以最早的成員為 leader 重建整批
+    for members in pending_groups.values():
+        app.logger.info(f"Rebuilding burst {members[0]['data']['burst_group']} from {len(members)} pending messages")
+        submit_recovery(run_pending_group, [(job["id"], job["attempts"]) for job in members])
+
+def lease_renewal_loop():
+    """續約獨立一條執行緒，不受復原中的長工作影響；每個租約期間至少續約三次"""
+    while True:
+        try:
+            journal_renew_leases()
+        except Exception as e:
+            app.logger.error(f"Error renewing job leases: {e}")
+        time.sleep(max(1, JOB_LEASE_SECONDS / 3))
 
+def job_recovery_loop():
+    while True:
         try:
-            # 1. 使用 OpenAI Whisper 轉錄
-            with open(temp_file_path, "rb") as audio_file:
-                transcript = openai_client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file,
-                    response_format="text"
-                )
-            
-            raw_text = transcript if isinstance(transcript, str) else transcript.text
-            
-            # 2. 使用 OpenAI 生成標題與摘要
-            ai_title, ai_summary = get_ai_title_and_summary(raw_text)
-
-            # 3. 儲存到 Notion
-            notion_status = ""
-            record_time = ""
-            if notion_token and notion_database_id and "your_" not in notion_token:
-                success, time_str = save_to_notion_enhanced(raw_text, ai_title, ai_summary, user_id)
-                if success:
-                    notion_status = "\n\n(已儲存摘要至 Notion)"
-                    record_time = time_str
-                else:
-                    notion_status = "\n\n(Notion 儲存失敗)"
-            
-            # 4. 回覆使用者
-            reply_msg = f"【{ai_title}】\n\n{ai_summary}\n\n---\n原始語音：{raw_text}\n\n時間：{record_time}{notion_status}"
-            
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_msg)]
-                )
-            )
+            recover_unfinished_jobs()
+            journal_prune()
+            state_backend.prune()
         except Exception as e:
-            app.logger.error(f"Error processing audio: {e}")
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="抱歉，語音處理失敗。")]
-                )
+            app.logger.error(f"Error in job recovery loop: {e}")
+        time.sleep(JOB_RECOVERY_INTERVAL)
+
+# 每日摘要：開啟的使用者，一段期間 (UTC+8 的一天，到 DIGEST_SEND_AT 為止) 內的筆記
+# 會在寄送時間彙整成一則 push 並存入 Notion。"only" 模式下文字、網址與語音筆記不再個別摘要與儲存。
+DIGEST_ENABLED = os.getenv('DIGEST_ENABLED', 'false').lower() == 'true'
+DIGEST_SEND_AT = os.getenv('DIGEST_SEND_AT', '23:30')
+DIGEST_SEND_HOUR, DIGEST_SEND_MINUTE = (int(part) for part in DIGEST_SEND_AT.split(":"))
+DIGEST_CHECK_INTERVAL = int(os.getenv('DIGEST_CHECK_INTERVAL', '60'))
+# digest-only 的筆記沒有個別摘要，每則只保留這麼多 token 的原文送進每日摘要
+DIGEST_NOTE_MAX_TOKENS = int(os.getenv('DIGEST_NOTE_MAX_TOKENS', '1500'))
+DIGEST_KINDS = {"text", "url", "urls", "audio"}
+DIGEST_KIND_LABELS = {"text": "文字", "url": "網頁", "urls": "網頁", "audio": "語音"}
+DIGEST_MODE_DESCRIPTIONS = {
+    "on": f"每日摘要：開啟。筆記照常個別回覆，並於每天 {DIGEST_SEND_AT} 彙整成一則每日摘要。",
+    "only": f"每日摘要：僅每日摘要。文字、網址與語音筆記不再個別摘要，於每天 {DIGEST_SEND_AT} 統一整理送出。",
+    "off": "每日摘要：關閉。",
+}
+
+# 模式與待寄送的筆記存在工作日誌 (SQLite) 中：重新部署不會遺失，同一台機器上的所有 worker 共用。
+# 筆記只在 push 與 Notion 都成功後才刪除；失敗的寄送在租約到期後重試。
+DIGEST_RUN_LEASE_SECONDS = int(os.getenv('DIGEST_RUN_LEASE_SECONDS', '600'))
+
+def init_digest_store():
+    conn = _journal_conn()
+    conn.execute("CREATE TABLE IF NOT EXISTS digest_modes (user_id TEXT PRIMARY KEY, mode TEXT NOT NULL)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS digest_notes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            day TEXT NOT NULL,
+            job_id TEXT NOT NULL,
+            note TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_digest_notes_day ON digest_notes (day, user_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_digest_notes_job ON digest_notes (job_id)")
+    # 寄送進度：digest 與 notion_status 記下已完成的步驟，重試時不會重複摘要或重複存入 Notion
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS digest_runs (
+            user_id TEXT NOT NULL,
+            day TEXT NOT NULL,
+            owner TEXT,
+            lease_until REAL NOT NULL DEFAULT 0,
+            digest TEXT,
+            notion_status TEXT,
+            PRIMARY KEY (user_id, day)
+        )
+    """)
+
+def digest_mode(user_id):
+    if not DIGEST_ENABLED:
+        return "off"
+    row = _journal_conn().execute("SELECT mode FROM digest_modes WHERE user_id = ?", (user_id,)).fetchone()
+    return row["mode"] if row else "off"
+
+def digest_command_reply(user_id, mode):
+    if not DIGEST_ENABLED:
+        return "每日摘要功能未啟用。"
+    if mode in DIGEST_MODE_DESCRIPTIONS:
+        _journal_conn().execute("INSERT OR REPLACE INTO digest_modes (user_id, mode) VALUES (?, ?)", (user_id, mode))
+    return f"{DIGEST_MODE_DESCRIPTIONS[digest_mode(user_id)]}\n\n指令：/digest on | only | off"
+
+def digest_day(now=None):
+    """筆記所屬的摘要日；超過當天寄送時間的筆記併入隔天"""
+    now = now or datetime.now(timezone(timedelta(hours=8)))
+    day = now.date()
+    if (now.hour, now.minute) >= (DIGEST_SEND_HOUR, DIGEST_SEND_MINUTE):
+        day += timedelta(days=1)
+    return day.isoformat()
+
+def digest_ack(job):
+    ack = f"已加入每日摘要，將於 {DIGEST_SEND_AT} 統一整理送出。"
+    if job["kind"] == "audio":
+        return f"{ack}\n\n---\n原始語音：{job['data']['transcript']}"
+    return ack
+
+def digest_notes_from_job(job):
+    """有個別摘要時只保留摘要；digest-only 的筆記保留完整原文 (存入 Notion)，摘要時只送截斷後的部分"""
+    data = job["data"]
+    if job["kind"] == "urls":
+        sources = [(link.get("ai_title"), link.get("ai_summary"), link.get("content"), link["url"]) for link in data.get("links", [])]
+    else:
+        content = {"text": data.get("text"), "url": data.get("web_content"), "audio": data.get("transcript")}[job["kind"]]
+        sources = [(data.get("ai_title"), data.get("ai_summary"), content, data.get("url"))]
+    notes = []
+    for title, summary, content, url in sources:
+        body = summary or truncate_to_tokens(content or "", DIGEST_NOTE_MAX_TOKENS)
+        if body:
+            notes.append({
+                "kind": job["kind"], "time": current_time_display(), "title": title or "", "body": body,
+                "content": None if summary else content, "url": url
+            })
+    return notes
+
+def record_digest_notes(job):
+    """把工作的筆記加入使用者這一期的每日摘要；重跑的工作不會重複加入"""
+    if job["data"].get("digest_recorded"):
+        return
+    conn = _journal_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if not conn.execute("SELECT 1 FROM digest_notes WHERE job_id = ? LIMIT 1", (job["id"],)).fetchone():
+            day = digest_day()
+            conn.executemany(
+                "INSERT INTO digest_notes (user_id, day, job_id, note) VALUES (?, ?, ?, ?)",
+                [(job["user_id"], day, job["id"], json.dumps(note, ensure_ascii=False)) for note in digest_notes_from_job(job)]
             )
-        finally:
-            # 清理暫存檔
-            if os.path.exists(temp_file_path):
-                os.remove(temp_file_path)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    journal_advance(job, digest_recorded=True)
+
+def claim_digest_run(user_id, day):
+    """取得某位使用者某一天的寄送租約；其他 worker 正在寄送時回傳 None"""
+    now = time.time()
+    conn = _journal_conn()
+    conn.execute("INSERT OR IGNORE INTO digest_runs (user_id, day) VALUES (?, ?)", (user_id, day))
+    cur = conn.execute(
+        "UPDATE digest_runs SET owner = ?, lease_until = ? WHERE user_id = ? AND day = ? AND lease_until < ?",
+        (_worker_id(), now + DIGEST_RUN_LEASE_SECONDS, user_id, day, now)
+    )
+    if not cur.rowcount:
+        return None
+    return dict(conn.execute("SELECT * FROM digest_runs WHERE user_id = ? AND day = ?", (user_id, day)).fetchone())
 
-def upload_to_drive(file_path, original_filename):
-    """上傳檔案至 Google Drive"""
-    drive_folder_id = os.getenv('GOOGLE_DRIVE_FOLDER_ID')
-    
-    # 支援從環境變數讀取 JSON 字串
-    token_json_str = os.getenv('GOOGLE_TOKEN_JSON')
-    creds_json_str = os.getenv('GOOGLE_CREDENTIALS_JSON')
-    
-    token_file = os.getenv('GOOGLE_OAUTH_TOKEN', 'token.json')
-    credential_file = os.getenv('GOOGLE_OAUTH_CREDENTIALS', 'credentials.json')
+def update_digest_run(user_id, day, **progress):
+    for column, value in progress.items():
+        _journal_conn().execute(f"UPDATE digest_runs SET {column} = ? WHERE user_id = ? AND day = ?", (value, user_id, day))
 
-    if not drive_folder_id:
-        app.logger.error("GOOGLE_DRIVE_FOLDER_ID is not set.")
-        return None
+@tracked_job
+def send_daily_digest(user_id, day):
+    """一次摘要使用者這一期的所有筆記，存入 Notion 並 push 一則訊息；都成功後才刪除筆記"""
+    run = claim_digest_run(user_id, day)
+    if run is None:
+        return
+    conn = _journal_conn()
+    rows = conn.execute(
+        "SELECT id, note FROM digest_notes WHERE user_id = ? AND day = ? ORDER BY id", (user_id, day)
+    ).fetchall()
+    if not rows:
+        conn.execute("DELETE FROM digest_runs WHERE user_id = ? AND day = ?", (user_id, day))
+        return
+    notes = [json.loads(row["note"]) for row in rows]
+    last_id = rows[-1]["id"]
 
-    creds = None
-    SCOPES = ['https://www.googleapis.com/auth/drive.file']
+    def section(i, note, text):
+        return (f"{i}. [{DIGEST_KIND_LABELS[note['kind']]}] {note['time']} {note['title']}\n{text}"
+                + (f"\n來源：{note['url']}" if note.get("url") else ""))
 
-    # 1. 優先嘗試從環境變數讀取 Token
-    if token_json_str:
+    digest = run["digest"]
+    if digest is None:
+        sections = "\n\n".join(section(i, note, note["body"]) for i, note in enumerate(notes, 1))
         try:
-            app.logger.info("Attempting to use GOOGLE_TOKEN_JSON from environment variables.")
-            token_info = json.loads(token_json_str)
-            creds = Credentials.from_authorized_user_info(token_info, SCOPES)
+            digest = chat_completion(
+                "daily_digest",
+                "以下是使用者今天記下的筆記，請依主題整理成條列式的每日摘要，合併重複的內容，最後列出值得追蹤的事項。",
+                sections,
+                Deadline.unbounded()
+            )
         except Exception as e:
-            app.logger.error(f"Error parsing GOOGLE_TOKEN_JSON from env: {e}")
-
-    # 2. 如果沒讀到，嘗試從檔案讀取 Token
-    if not creds:
-        if os.path.exists(token_file):
-            try:
-                app.logger.info(f"Attempting to use token file: {token_file}")
-                creds = Credentials.from_authorized_user_file(token_file, SCOPES)
-            except Exception as e:
-                app.logger.error(f"Error loading token from file {token_file}: {e}")
-        else:
-            app.logger.warning(f"Token file {token_file} not found.")
-    
-    # 3. 檢查憑證是否有效，若過期嘗試刷新
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            try:
-                app.logger.info("Refreshing expired Google Drive token...")
-                creds.refresh(Request())
-                
-                # 如果是檔案模式，嘗試更新檔案
-                if os.path.exists(token_file):
-                    try:
-                        with open(token_file, 'w') as token:
-                            token.write(creds.to_json())
-                        app.logger.info(f"Successfully updated token file: {token_file}")
-                    except Exception as fe:
-                        app.logger.error(f"Failed to write updated token to file: {fe}")
-            except Exception as e:
-                app.logger.error(f"Error refreshing token: {e}")
-                return None
-        else:
-            msg = "Google Drive token is missing, invalid, or lacks refresh_token."
-            if not creds:
-                msg += " (No credentials could be loaded)"
-            app.logger.error(msg)
-            return None
+            app.logger.error(f"Error in daily digest processing for {user_id}: {e}")
+            digest = "無法產生每日摘要，完整筆記請見 Notion 或下方列表。"
+        update_digest_run(user_id, day, digest=digest)
+
+    title = f"每日摘要 {day}"
+    notion_status = run["notion_status"]
+    if notion_status is None:
+        notion_status = ""
+        if notion_token and notion_database_id and "your_" not in notion_token:
+            # only 模式下這是筆記唯一的 Notion 記錄，頁面內容保留每則筆記的完整原文
+            full_text = "\n\n".join(section(i, note, note.get("content") or note["body"]) for i, note in enumerate(notes, 1))
+            success, _ = save_to_notion_enhanced(full_text, title, digest, user_id, type_name="每日摘要", full_text=True)
+            if not success:
+                raise RuntimeError("Notion save failed, will retry")
+            notion_status = "\n\n(已儲存摘要至 Notion)"
+        update_digest_run(user_id, day, notion_status=notion_status)
+
+    index = "\n".join(f"{i}. {note['title'] or note['body'][:30]}" for i, note in enumerate(notes, 1))
+    deliver_message(user_id, f"【{title}】({len(notes)} 則筆記)\n\n{digest}\n\n---\n{index}{notion_status}")
+
+    conn.execute("DELETE FROM digest_notes WHERE user_id = ? AND day = ? AND id <= ?", (user_id, day, last_id))
+    conn.execute("DELETE FROM digest_runs WHERE user_id = ? AND day = ?", (user_id, day))
+
+def digest_scheduler_loop():
+    while True:
+        try:
+            # 目前收集中的摘要日之前的筆記都已到寄送時間 (包含停機或失敗而尚未寄出的)
+            due = _journal_conn().execute(
+                "SELECT DISTINCT user_id, day FROM digest_notes WHERE day < ?", (digest_day(),)
+            ).fetchall()
+            for row in due:
+                try:
+                    send_daily_digest(row["user_id"], row["day"])
+                except Exception as e:
+                    app.logger.error(f"Failed to send daily digest {row['day']} to {row['user_id']}: {e}")
+        except Exception as e:
+            app.logger.error(f"Error in digest scheduler loop: {e}")
+        time.sleep(DIGEST_CHECK_INTERVAL)
 
-    try:
-        service = build('drive', 'v3', credentials=creds)
-        
-        file_metadata = {
-            'name': original_filename,
-            'parents': [drive_folder_id]
-        }
-        media = MediaFileUpload(file_path, resumable=True)
-        
-        file = service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields='id, webViewLink'
-        ).execute()
-        
-        return file.get('webViewLink')
-        
-    except Exception as e:
-        app.logger.error(f"Error uploading to Drive: {e}")
-        return None
+@handler.add(MessageEvent, message=ImageMessageContent)
+@profiled
+def handle_image_message(event):
+    user_id = event.source.user_id
+    if allowed_user_id and user_id != allowed_user_id:
+        return
 
-import base64
+    # 同一組 (imageSet) 或視窗內連續傳送的圖片合併處理
+    image_set = event.message.image_set
+    if image_set and image_set.id:
+        group_key, expected = f"imageset:{user_id}:{image_set.id}", image_set.total
+        window = BURST_WINDOW_SECONDS or 3
+    elif BURST_WINDOW_SECONDS > 0:
+        group_key, expected = f"image:{user_id}", None
+        window = BURST_WINDOW_SECONDS
+    else:
+        start_job(event, "image")
+        return
 
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+    accept_burst_item(event, "image", group_key, {"index": image_set.index if image_set else None}, window, expected)
 
-@handler.add(MessageEvent, message=ImageMessageContent)
-def handle_image_message(event):
+@handler.add(MessageEvent, message=VideoMessageContent)
+@profiled
+def handle_video_message(event):
     user_id = event.source.user_id
     if allowed_user_id and user_id != allowed_user_id:
         return
 
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_blob_api = MessagingApiBlob(api_client)
+    # 外部影片 (content_provider 為 external) 無法透過 LINE API 下載
+    if event.message.content_provider and event.message.content_provider.type == "external":
+        deliver_message(user_id, "抱歉，無法下載外部來源的影片。", event.reply_token)
+        return
 
-        try:
-            # 取得圖片內容
-            message_content = line_bot_blob_api.get_message_content(message_id=event.message.id)
-            
-            # 暫存圖片
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as tf:
-                tf.write(message_content)
-                temp_file_path = tf.name
-
-            # 上傳至 Google Drive
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"line_image_{timestamp}.jpg"
-            drive_link = upload_to_drive(temp_file_path, filename)
-            
-            if drive_link:
-                # 使用 GPT-4o 辨識圖片內容
-                try:
-                    base64_image = encode_image(temp_file_path)
-                    response = openai_client.chat.completions.create(
-                        model="gpt-4o",
-                        messages=[
-                            {
-                                "role": "user",
-                                "content": [
-                                    {"type": "text", "text": "請描述這張圖片的內容，並為它下一個精簡的標題(15字內)。格式範例：\n標題：[標題]\n內容：[詳細描述]"},
-                                    {
-                                        "type": "image_url",
-                                        "image_url": {
-                                            "url": f"data:image/jpeg;base64,{base64_image}"
-                                        },
-                                    },
-                                ],
-                            }
-                        ],
-                        max_tokens=500,
-                    )
-                    ai_response = response.choices[0].message.content
-                    
-                    # 解析回應
-                    ai_title = "圖片筆記"
-                    ai_summary = ai_response
-                    
-                    if "標題：" in ai_response and "內容：" in ai_response:
-                        parts = ai_response.split("內容：")
-                        ai_title = parts[0].replace("標題：", "").strip()
-                        ai_summary = parts[1].strip()
-                    
-                except Exception as ai_e:
-                    app.logger.error(f"Error in AI vision processing: {ai_e}")
-                    ai_title = "圖片筆記"
-                    ai_summary = f"無法辨識圖片內容。Drive 連結: {drive_link}"
-
-                # 儲存至 Notion
-                notion_status = ""
-                record_time = ""
-                if notion_token and notion_database_id and "your_" not in notion_token:
-                    success, time_str = save_to_notion_enhanced(
-                        f"圖片連結: {drive_link}\n\nAI 描述: {ai_summary}", 
-                        ai_title, 
-                        ai_summary, 
-                        user_id, 
-                        type_name="圖片",
-                        url=drive_link
-                    )
-                    if success:
-                        notion_status = "\n\n(已記錄至 Notion)"
-                        record_time = time_str
-                    else:
-                        notion_status = "\n\n(Notion 儲存失敗)"
-                else:
-                    tz = timezone(timedelta(hours=8))
-                    record_time = datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
+    start_job(event, "video")
 
-                reply_msg = f"【{ai_title}】\n\n{ai_summary}\n\n---\n連結：{drive_link}\n時間：{record_time}{notion_status}"
-            else:
-                reply_msg = "圖片上傳失敗，請檢查後端日誌或確認授權狀態。"
+@handler.add(MessageEvent, message=FileMessageContent)
+@profiled
+def handle_file_message(event):
+    user_id = event.source.user_id
+    if allowed_user_id and user_id != allowed_user_id:
+        return
 
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_msg)]
-                )
-            )
+    start_job(event, "file", {"file_name": event.message.file_name})
 
-        except Exception as e:
-            app.logger.error(f"Error processing image: {e}")
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text="抱歉，圖片處理失敗。")]
-                )
-            )
-        finally:
-            if os.path.exists(temp_file_path):
-                os.remove(temp_file_path)
+# 建立工作日誌，並在背景續約及續跑中斷的工作
+init_job_journal()
+init_digest_store()
+threading.Thread(target=lease_renewal_loop, daemon=True).start()
+threading.Thread(target=job_recovery_loop, daemon=True).start()
+if DIGEST_ENABLED:
+    threading.Thread(target=digest_scheduler_loop, daemon=True).start()
 
 if __name__ == "__main__":
     # Zeabur 會提供 PORT 環境變數
@@ -0,0 +1,85 @@
+"""連續訊息合併的檢查：待合併工作的併入、已被收下的成員略過，以及 leader 交接時不遺漏成員。
+
+執行：python -m pytest tests/test_burst.py
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+_tmp = tempfile.mkdtemp()
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("JOB_DB_PATH", os.path.join(_tmp, "jobs.db"))
+os.environ.setdefault("JOB_RECOVERY_INTERVAL", "3600")
+os.environ["STATE_BACKEND_URL"] = "memory://"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def build(jobs):
+    return app.BURST_BUILDERS[jobs[0]["kind"]](jobs)
+
+
+def pending_note(job_id, text, group="note:U-burst"):
+    job = app.journal_accept(job_id, "U-burst", "text", {"text": text, "burst_group": group}, stage="pending")
+    # 讓 created_at 有先後順序
+    time.sleep(0.01)
+    return job
+
+
+def test_merge_pending_combines_members_into_earliest():
+    pending_note("n1", "第一則")
+    pending_note("n2", "第二則")
+    pending_note("n3", "第三則")
+
+    leader = app.journal_merge_pending([("n3", 0), ("n1", 0), ("n2", 0)], build)
+    assert leader["id"] == "n1"
+    assert leader["stage"] == "accepted"
+    assert leader["data"]["text"] == "第一則\n\n第二則\n\n第三則"
+    assert leader["data"]["note_count"] == 3
+    for job_id in ("n2", "n3"):
+        member = app.journal_get(job_id)
+        assert member["stage"] == "replied"
+        assert member["data"]["merged_into"] == "n1"
+    assert app.journal_get("n1")["stage"] == "accepted"
+
+
+def test_merge_pending_skips_members_claimed_by_recovery():
+    pending_note("r1", "a")
+    pending_note("r2", "b")
+    # 復原流程認領時 attempts 會加一
+    app._journal_conn().execute("UPDATE jobs SET attempts = 1 WHERE id = 'r1'")
+
+    leader = app.journal_merge_pending([("r1", 0), ("r2", 0)], build)
+    assert leader["id"] == "r2"
+    assert leader["data"]["note_count"] == 1
+    assert app.journal_get("r1")["stage"] == "pending"
+
+
+def test_merge_pending_keeps_members_when_leader_was_merged_elsewhere():
+    pending_note("l1", "a")
+    pending_note("l2", "b")
+    pending_note("l3", "c")
+    # 前一個 leader 在解除前把 l1 收走了，新的 leader (l1) 取出的批次中仍有 l2、l3
+    assert app.journal_merge_pending([("l1", 0)], build)["id"] == "l1"
+
+    leader = app.journal_merge_pending([("l1", 0), ("l2", 0), ("l3", 0)], build)
+    assert leader["id"] == "l2"
+    assert leader["data"]["text"] == "b\n\nc"
+    assert app.journal_get("l3")["data"]["merged_into"] == "l2"
+
+
+def test_merge_pending_returns_none_without_pending_members():
+    assert app.journal_merge_pending([("missing", 0)], build) is None
+
+
+def test_merge_pending_orders_image_batches_by_index():
+    app.journal_accept("i2", "U-burst", "image", {"index": 2, "burst_group": "imageset:U-burst:s"}, stage="pending")
+    app.journal_accept("i1", "U-burst", "image", {"index": 1, "burst_group": "imageset:U-burst:s"}, stage="pending")
+    leader = app.journal_merge_pending([("i1", 0), ("i2", 0)], build)
+    assert leader["kind"] == "image_batch"
+    assert leader["data"]["message_ids"] == ["i1", "i2"]
@@ -0,0 +1,123 @@
+"""時間預算的檢查：逾時與 max_tokens 的計算、降級的觸發，以及預算用完時交給背景完成。
+
+執行：python -m pytest tests/test_deadline.py
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+_tmp = tempfile.mkdtemp()
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("JOB_DB_PATH", os.path.join(_tmp, "jobs.db"))
+os.environ.setdefault("JOB_RECOVERY_INTERVAL", "3600")
+os.environ["STATE_BACKEND_URL"] = "memory://"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def test_max_tokens_never_exceeds_cap():
+    deadline = app.Deadline(time.time() + 30)
+    assert deadline.max_tokens(60) == 60
+    assert 64 < deadline.max_tokens(5000) <= 15 * app.OPENAI_OUTPUT_TOKENS_PER_SECOND
+
+
+def test_max_tokens_keeps_floor_when_budget_is_short(monkeypatch):
+    monkeypatch.setattr(app, "OPENAI_OUTPUT_TOKENS_PER_SECOND", 10)
+    deadline = app.Deadline(time.time() + 10)
+    assert deadline.max_tokens(1000) == 64
+    assert deadline.max_tokens(50) == 50
+
+
+def test_max_tokens_unbounded_uses_cap():
+    assert app.Deadline.unbounded().max_tokens(1000) == 1000
+
+
+def test_timeout_is_capped_by_remaining_budget():
+    deadline = app.Deadline(time.time() + 20)
+    assert 19 < deadline.timeout(60) <= 20
+    assert deadline.timeout(5) == 5
+    assert deadline.degradations == []
+
+
+def test_timeout_below_floor_switches_to_push():
+    deadline = app.Deadline(time.time() + 8)
+    assert deadline.timeout(120, floor=10) == 120
+    assert deadline.degradations == ["push_delivery"]
+    assert deadline.push_only()
+
+
+def test_degradations_fire_in_threshold_order():
+    deadline = app.Deadline(time.time() + 25)
+    assert deadline.below(app.DEGRADE_DEFER_NOTION_BELOW, "defer_notion")
+    assert not deadline.below(app.DEGRADE_SHORT_SUMMARY_BELOW, "short_summary")
+    assert not deadline.push_only()
+    assert deadline.degradations == ["defer_notion"]
+
+
+def test_call_with_budget_retries_budget_timeouts_with_full_cap():
+    deadline = app.Deadline(time.time() + 10)
+    timeouts = []
+
+    def call(timeout):
+        timeouts.append(timeout)
+        if len(timeouts) == 1:
+            raise TimeoutError()
+        return "ok"
+
+    assert app.call_with_budget(deadline, 60, call) == "ok"
+    assert timeouts[0] <= 10 and timeouts[1] == 60
+    assert "push_delivery" in deadline.degradations
+
+
+def test_call_with_budget_does_not_retry_full_cap_timeouts():
+    calls = []
+
+    def call(timeout):
+        calls.append(timeout)
+        raise TimeoutError()
+
+    try:
+        app.call_with_budget(app.Deadline.unbounded(), 15, call)
+    except TimeoutError:
+        pass
+    else:
+        raise AssertionError("expected a timeout")
+    assert calls == [15]
+
+
+def test_launch_job_hands_off_to_background_when_budget_runs_out(monkeypatch):
+    release = threading.Event()
+    delivered = []
+
+    def slow_processor(job, deadline):
+        release.wait(5)
+        return "done"
+
+    monkeypatch.setitem(app.JOB_PROCESSORS, "text", slow_processor)
+    monkeypatch.setattr(app, "deliver_message", lambda user_id, text, reply_token=None: delivered.append(reply_token))
+    event = SimpleNamespace(
+        timestamp=(time.time() - app.REPLY_BUDGET_SECONDS + 0.3) * 1000,
+        reply_token="reply-token",
+        message=SimpleNamespace(id="handoff-job", type="text"),
+        source=SimpleNamespace(user_id="U-handoff")
+    )
+    started = time.time()
+    app.launch_job(event, "text", {"text": "hello"})
+    # webhook 請求在預算用完時就返回，不等工作完成
+    assert time.time() - started < 2
+    assert app.journal_get("handoff-job")["stage"] == "accepted"
+
+    release.set()
+    for _ in range(50):
+        if app.journal_get("handoff-job")["stage"] == "replied":
+            break
+        time.sleep(0.1)
+    assert app.journal_get("handoff-job")["stage"] == "replied"
+    assert delivered == [None]
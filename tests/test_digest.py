@@ -0,0 +1,91 @@
+"""每日摘要的檢查：摘要日的切分、筆記的記錄與未開啟時不寫入任何筆記。
+
+執行：python -m pytest tests/test_digest.py
+"""
+
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+_tmp = tempfile.mkdtemp()
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("JOB_DB_PATH", os.path.join(_tmp, "jobs.db"))
+os.environ.setdefault("JOB_RECOVERY_INTERVAL", "3600")
+os.environ["STATE_BACKEND_URL"] = "memory://"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+TAIPEI = timezone(timedelta(hours=8))
+
+
+def note_count(job_id):
+    return app._journal_conn().execute("SELECT COUNT(*) FROM digest_notes WHERE job_id = ?", (job_id,)).fetchone()[0]
+
+
+def fake_urls_job(monkeypatch, job_id, user_id):
+    monkeypatch.setattr(app, "deliver_message", lambda *args, **kwargs: None)
+    monkeypatch.setattr(app, "fetch_url_content", lambda url, deadline=None: f"content of {url}")
+    monkeypatch.setattr(app, "get_ai_title_and_summary", lambda text, deadline=None: ("title", "summary"))
+    monkeypatch.setattr(app, "get_ai_digest", lambda links, note="", deadline=None: "combined digest")
+    monkeypatch.setattr(app, "notion_token", None)
+    data = app.with_digest_flags(user_id, "urls", {"urls": ["https://a.example/1", "https://b.example/2"], "note": ""})
+    job = app.journal_accept(job_id, user_id, "urls", data)
+    app.run_job(job)
+    return app.journal_get(job_id)
+
+
+def test_digest_day_rolls_over_at_send_time(monkeypatch):
+    monkeypatch.setattr(app, "DIGEST_SEND_HOUR", 23)
+    monkeypatch.setattr(app, "DIGEST_SEND_MINUTE", 30)
+    assert app.digest_day(datetime(2026, 10, 19, 8, 0, tzinfo=TAIPEI)) == "2026-10-19"
+    assert app.digest_day(datetime(2026, 10, 19, 23, 29, tzinfo=TAIPEI)) == "2026-10-19"
+    assert app.digest_day(datetime(2026, 10, 19, 23, 30, tzinfo=TAIPEI)) == "2026-10-20"
+    assert app.digest_day(datetime(2026, 12, 31, 23, 45, tzinfo=TAIPEI)) == "2027-01-01"
+
+
+def test_urls_job_writes_no_notes_when_digest_disabled(monkeypatch):
+    monkeypatch.setattr(app, "DIGEST_ENABLED", False)
+    job = fake_urls_job(monkeypatch, "digest-off-disabled", "U-off")
+    # 綜合摘要文字存在 data["digest"]，不應被當成每日摘要的開關
+    assert job["data"]["digest"] == "combined digest"
+    assert job["stage"] == "replied"
+    assert note_count("digest-off-disabled") == 0
+
+
+def test_urls_job_writes_no_notes_when_mode_off(monkeypatch):
+    monkeypatch.setattr(app, "DIGEST_ENABLED", True)
+    app.digest_command_reply("U-mode-off", "off")
+    fake_urls_job(monkeypatch, "digest-off-mode", "U-mode-off")
+    assert note_count("digest-off-mode") == 0
+
+
+def test_urls_job_records_one_note_per_link_when_mode_on(monkeypatch):
+    monkeypatch.setattr(app, "DIGEST_ENABLED", True)
+    app.digest_command_reply("U-mode-on", "on")
+    job = fake_urls_job(monkeypatch, "digest-on", "U-mode-on")
+    assert job["data"]["digest_mode"] == "on"
+    assert note_count("digest-on") == 2
+
+
+def test_record_digest_notes_is_idempotent_and_keeps_raw_content(monkeypatch):
+    monkeypatch.setattr(app, "DIGEST_ENABLED", True)
+    job = app.journal_accept("digest-only-text", "U-only", "text", {"text": "原文" * 10, "digest_mode": "only"})
+    app.record_digest_notes(job)
+    # 重跑時 (例如復原流程) 不會重複加入
+    job["data"].pop("digest_recorded")
+    app.record_digest_notes(job)
+    rows = app._journal_conn().execute("SELECT note FROM digest_notes WHERE job_id = ?", ("digest-only-text",)).fetchall()
+    assert len(rows) == 1
+    note = app.json.loads(rows[0]["note"])
+    assert note["content"] == "原文" * 10
+    assert note["body"] == "原文" * 10
+
+
+def test_record_digest_notes_skips_empty_content():
+    job = app.journal_accept("digest-empty-url", "U-empty", "url", {"url": "https://x.example", "digest_mode": "on"})
+    app.record_digest_notes(job)
+    assert note_count("digest-empty-url") == 0
@@ -0,0 +1,61 @@
+"""網頁快取的檢查：Cache-Control 的解析，以及依回應標頭與網域設定決定的保存秒數。
+
+執行：python -m pytest tests/test_http_cache.py
+"""
+
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+_tmp = tempfile.mkdtemp()
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("JOB_DB_PATH", os.path.join(_tmp, "jobs.db"))
+os.environ.setdefault("JOB_RECOVERY_INTERVAL", "3600")
+os.environ["STATE_BACKEND_URL"] = "memory://"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+URL = "https://news.example.com/article"
+
+
+def response(**headers):
+    return SimpleNamespace(headers={name.replace("_", "-"): value for name, value in headers.items()})
+
+
+def test_parse_cache_control():
+    assert app.parse_cache_control('Public, Max-Age=600, s-maxage="120", no-transform') == {
+        "public": "", "max-age": "600", "s-maxage": "120", "no-transform": ""
+    }
+    assert app.parse_cache_control("") == {}
+
+
+def test_no_store_and_private_are_not_cached():
+    assert app.cache_freshness(URL, response(Cache_Control="no-store")) == (False, 0)
+    assert app.cache_freshness(URL, response(Cache_Control="private, max-age=600")) == (False, 0)
+
+
+def test_no_cache_is_stored_but_always_revalidated():
+    assert app.cache_freshness(URL, response(Cache_Control="no-cache, max-age=600")) == (True, 0)
+
+
+def test_shared_max_age_wins_over_max_age():
+    assert app.cache_freshness(URL, response(Cache_Control="max-age=600, s-maxage=60")) == (True, 60)
+    assert app.cache_freshness(URL, response(Cache_Control="max-age=600")) == (True, 600)
+
+
+def test_expires_is_relative_to_date_header():
+    headers = response(Date="Mon, 19 Oct 2026 08:00:00 GMT", Expires="Mon, 19 Oct 2026 08:05:00 GMT")
+    assert app.cache_freshness(URL, headers) == (True, 300)
+    assert app.cache_freshness(URL, response(Date="Mon, 19 Oct 2026 08:00:00 GMT", Expires="0")) == (True, 0)
+
+
+def test_domain_ttl_applies_without_cache_headers(monkeypatch):
+    monkeypatch.setattr(app, "HTTP_CACHE_DOMAIN_TTLS", app.parse_domain_ttls("example.com=300, other.org = 60"))
+    monkeypatch.setattr(app, "HTTP_CACHE_DEFAULT_TTL", 5)
+    assert app.cache_freshness(URL, response()) == (True, 300)
+    assert app.cache_freshness("https://example.com.evil.net/", response()) == (True, 5)
+    assert app.cache_freshness("https://other.org/x", response()) == (True, 60)
@@ -0,0 +1,93 @@
+"""模型路由的檢查：依輸入長度與近期統計排序候選模型、輸出上限的計算與失敗時改用下一個模型。
+
+執行：python -m pytest tests/test_model_router.py
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+_tmp = tempfile.mkdtemp()
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("JOB_DB_PATH", os.path.join(_tmp, "jobs.db"))
+os.environ.setdefault("JOB_RECOVERY_INTERVAL", "3600")
+os.environ["STATE_BACKEND_URL"] = "memory://"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+ROUTES = {
+    "summary": [
+        {"model": "small", "max_input_tokens": 1000, "max_tokens": 500, "output_ratio": 0.5, "timeout": 10},
+        {"model": "large", "max_input_tokens": 100000, "max_tokens": 500, "timeout": 10},
+    ],
+}
+
+
+def models(candidates):
+    return [candidate["model"] for candidate in candidates]
+
+
+def test_rank_prefers_first_candidate_that_fits():
+    router = app.ModelRouter(ROUTES)
+    assert models(router.rank("summary", 500, app.Deadline.unbounded())) == ["small", "large"]
+    assert models(router.rank("summary", 5000, app.Deadline.unbounded())) == ["large"]
+
+
+def test_rank_falls_back_to_largest_when_nothing_fits():
+    router = app.ModelRouter(ROUTES)
+    assert models(router.rank("summary", 10 ** 6, app.Deadline.unbounded())) == ["large"]
+
+
+def test_rank_moves_failing_model_last(monkeypatch):
+    monkeypatch.setattr(app, "MODEL_PROBE_RATE", 0)
+    router = app.ModelRouter(ROUTES)
+    for _ in range(app.MODEL_MIN_SAMPLES):
+        router.record("summary", "small", 1, ok=False)
+    assert models(router.rank("summary", 500, app.Deadline.unbounded())) == ["large", "small"]
+
+
+def test_rank_moves_model_slower_than_remaining_budget_last(monkeypatch):
+    monkeypatch.setattr(app, "MODEL_PROBE_RATE", 0)
+    router = app.ModelRouter(ROUTES)
+    router.record("summary", "small", 30, ok=True)
+    router.record("summary", "large", 2, ok=True)
+    assert models(router.rank("summary", 500, app.Deadline(time.time() + 20))) == ["large", "small"]
+    assert models(router.rank("summary", 500, app.Deadline.unbounded())) == ["small", "large"]
+
+
+def test_rank_probes_demoted_model(monkeypatch):
+    monkeypatch.setattr(app, "MODEL_PROBE_RATE", 1)
+    router = app.ModelRouter(ROUTES)
+    for _ in range(app.MODEL_MIN_SAMPLES):
+        router.record("summary", "small", 1, ok=False)
+    assert models(router.rank("summary", 500, app.Deadline.unbounded())) == ["small", "large"]
+
+
+def test_output_cap_scales_with_input_tokens():
+    small, large = ROUTES["summary"]
+    assert app.ModelRouter.output_cap(small, 100) == 128
+    assert app.ModelRouter.output_cap(small, 600) == 300
+    assert app.ModelRouter.output_cap(small, 5000) == 500
+    assert app.ModelRouter.output_cap(large, 100) == 500
+    assert app.ModelRouter.output_cap({"model": "m"}, 100) == app.SUMMARY_MAX_TOKENS
+
+
+def test_call_falls_back_to_next_candidate_and_records_stats():
+    router = app.ModelRouter(ROUTES)
+    tried = []
+
+    def request(candidate, timeout):
+        tried.append(candidate["model"])
+        if candidate["model"] == "small":
+            raise RuntimeError("rate limited")
+        return "ok"
+
+    assert router.call("summary", app.Deadline.unbounded(), request, input_tokens=500) == "ok"
+    assert tried == ["small", "large"]
+    stats = {entry["model"]: entry for entry in router.snapshot()["summary"]}
+    assert stats["small"]["errors"] == 1
+    assert stats["large"]["calls"] == 1 and stats["large"]["errors"] == 0
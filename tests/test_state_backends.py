@@ -0,0 +1,222 @@
+"""共享狀態後端的檢查：三種後端跑同一組操作，Redis 後端連到以 socket 實作的假 RESP 伺服器。
+
+執行：python -m pytest tests/test_state_backends.py
+"""
+
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+_tmp = tempfile.mkdtemp()
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ["JOB_DB_PATH"] = os.path.join(_tmp, "jobs.db")
+os.environ["STATE_BACKEND_URL"] = "memory://"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """只實作 app 用到的指令；server.drop_next 可讓下一個指令在讀取後直接斷線"""
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        assert line[:1] == b"*"
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2].decode("utf-8"))
+        return args
+
+    def write(self, value):
+        if value is None:
+            self.wfile.write(b"$-1\r\n")
+        elif isinstance(value, int):
+            self.wfile.write(b":%d\r\n" % value)
+        elif value == "OK":
+            self.wfile.write(b"+OK\r\n")
+        else:
+            data = value.encode("utf-8")
+            self.wfile.write(b"$%d\r\n%s\r\n" % (len(data), data))
+
+    def handle(self):
+        try:
+            self.serve_commands()
+        except ConnectionError:
+            # 用戶端逾時後已自行斷線
+            pass
+
+    def serve_commands(self):
+        server = self.server
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            with server.lock:
+                server.commands.append(args)
+                if server.drop_next:
+                    # 模擬伺服器關閉閒置連線：指令未執行即斷線
+                    server.drop_next = False
+                    return
+                self.write(self.execute(server, args[0].upper(), args[1:]))
+                self.wfile.flush()
+
+    def execute(self, server, name, args):
+        data, expiry, lists = server.data, server.expiry, server.lists
+        if args and args[0] in expiry and expiry[args[0]] <= time.time():
+            data.pop(args[0], None)
+            expiry.pop(args[0], None)
+        if name in ("AUTH", "SELECT"):
+            return "OK"
+        if name == "GET":
+            return data.get(args[0])
+        if name == "SET":
+            key, value, options = args[0], args[1], [a.upper() for a in args[2:]]
+            if "NX" in options and key in data:
+                return None
+            data[key] = value
+            expiry.pop(key, None)
+            if "EX" in options:
+                expiry[key] = time.time() + int(args[2 + options.index("EX") + 1])
+            return "OK"
+        if name == "DEL":
+            return int(data.pop(args[0], None) is not None)
+        if name == "INCRBY":
+            value = int(data.get(args[0], 0)) + int(args[1])
+            data[args[0]] = str(value)
+            return value
+        if name == "EXPIRE":
+            expiry[args[0]] = time.time() + int(args[1])
+            return 1
+        if name == "RPUSH":
+            lists.setdefault(args[0], []).append(args[1])
+            return len(lists[args[0]])
+        if name == "LPOP":
+            items = lists.get(args[0])
+            return items.pop(0) if items else None
+        raise AssertionError(f"unexpected command {name}")
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeRedisHandler)
+        self.lock = threading.Lock()
+        self.data, self.expiry, self.lists = {}, {}, {}
+        self.commands = []
+        self.drop_next = False
+
+
+def start_fake_redis():
+    server = FakeRedisServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def exercise_backend(backend):
+    assert backend.get("k") is None
+    backend.set("k", "值")
+    assert backend.get("k") == "值"
+    backend.delete("k")
+    assert backend.get("k") is None
+
+    backend.set("short", "v", ttl=1)
+    assert backend.get("short") == "v"
+
+    assert backend.incr("count", ttl=60) == 1
+    assert backend.incr("count", ttl=60) == 2
+    assert backend.incr("count", amount=3) == 5
+
+    assert backend.set_if_absent("lock", "a", ttl=60)
+    assert not backend.set_if_absent("lock", "b", ttl=60)
+    assert backend.get("lock") == "a"
+
+    backend.push("q", "1")
+    backend.push("q", "2")
+    assert backend.pop("q") == "1"
+    assert backend.pop("q") == "2"
+    assert backend.pop("q") is None
+
+    time.sleep(1.1)
+    assert backend.get("short") is None
+    assert backend.set_if_absent("short", "again", ttl=60)
+    backend.prune()
+
+
+def test_in_memory_backend():
+    exercise_backend(app.InMemoryStateBackend())
+
+
+def test_sqlite_backend():
+    backend = app.SQLiteStateBackend(os.path.join(tempfile.mkdtemp(), "state.db"))
+    exercise_backend(backend)
+    backend.set("expired", "v", ttl=0.01)
+    time.sleep(0.05)
+    backend.prune()
+    assert backend._conn().execute("SELECT COUNT(*) FROM kv WHERE key = 'expired'").fetchone()[0] == 0
+
+
+def test_redis_backend_against_fake_server():
+    server = start_fake_redis()
+    try:
+        backend = app.create_state_backend(f"redis://:secret@127.0.0.1:{server.server_address[1]}/2")
+        assert isinstance(backend, app.RedisStateBackend)
+        exercise_backend(backend)
+        assert server.commands[0] == ["AUTH", "secret"]
+        assert server.commands[1] == ["SELECT", "2"]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_redis_backend_reconnects_after_closed_connection():
+    server = start_fake_redis()
+    try:
+        backend = app.RedisStateBackend(f"redis://127.0.0.1:{server.server_address[1]}")
+        backend.set("k", "v")
+        server.drop_next = True
+        # 連線被關閉時指令尚未執行，重新連線後重試一次即可
+        assert backend.incr("n") == 1
+        assert backend.get("k") == "v"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_redis_backend_does_not_retry_non_idempotent_after_timeout():
+    server = start_fake_redis()
+    try:
+        backend = app.RedisStateBackend(f"redis://127.0.0.1:{server.server_address[1]}")
+        backend.get("warmup")
+        backend._local.sock.settimeout(0.2)
+        with server.lock:
+            # 伺服器卡住時讀取回應會逾時，RPUSH 不應被重送
+            sent_before = len(server.commands)
+            try:
+                backend.push("q", "once")
+            except TimeoutError:
+                pass
+            else:
+                raise AssertionError("expected a timeout")
+            assert len(server.commands) == sent_before
+        time.sleep(0.2)
+        assert server.lists.get("q") == ["once"]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: ok")
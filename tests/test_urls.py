@@ -0,0 +1,55 @@
+"""網址擷取的檢查：結尾標點與括號、追蹤參數的去除，以及超過上限的連結數。
+
+執行：python -m pytest tests/test_urls.py
+"""
+
+import os
+import sys
+import tempfile
+
+_tmp = tempfile.mkdtemp()
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("JOB_DB_PATH", os.path.join(_tmp, "jobs.db"))
+os.environ.setdefault("JOB_RECOVERY_INTERVAL", "3600")
+os.environ["STATE_BACKEND_URL"] = "memory://"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def test_normalize_url_strips_sentence_punctuation():
+    assert app.normalize_url("https://example.com/a.") == "https://example.com/a"
+    assert app.normalize_url("https://example.com/a?!") == "https://example.com/a"
+    assert app.normalize_url("https://example.com/a),") == "https://example.com/a"
+
+
+def test_normalize_url_keeps_balanced_brackets():
+    wiki = "https://en.wikipedia.org/wiki/Python_(programming_language)"
+    assert app.normalize_url(wiki) == wiki
+    assert app.normalize_url(wiki + ").") == wiki
+    assert app.normalize_url("https://example.com/list[1]") == "https://example.com/list[1]"
+    assert app.normalize_url("https://example.com/list]") == "https://example.com/list"
+
+
+def test_normalize_url_removes_only_tracking_params():
+    assert app.normalize_url("https://example.com/p?id=1&utm_source=x&fbclid=y#top") == "https://example.com/p?id=1#top"
+    assert app.normalize_url("https://example.com/p?UTM_Medium=x") == "https://example.com/p"
+    # 其他參數的寫法與編碼保持原樣
+    assert app.normalize_url("https://example.com/s?q=a%20b&flag&x=1") == "https://example.com/s?q=a%20b&flag&x=1"
+
+
+def test_extract_urls_dedupes_after_normalizing():
+    text = "看這篇 https://example.com/a?utm_source=line 還有 https://example.com/a，以及 https://example.com/b。"
+    assert app.extract_urls(text) == (["https://example.com/a", "https://example.com/b"], 0)
+
+
+def test_extract_urls_reports_links_over_the_limit(monkeypatch):
+    monkeypatch.setattr(app, "MAX_URLS_PER_MESSAGE", 2)
+    text = " ".join(f"https://example.com/{i}" for i in range(5))
+    assert app.extract_urls(text) == (["https://example.com/0", "https://example.com/1"], 3)
+
+
+def test_extract_urls_without_links():
+    assert app.extract_urls("沒有連結的訊息") == ([], 0)